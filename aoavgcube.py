@@ -1,29 +1,55 @@
 import sys
-import tempfile
-import shutil
 import os.path
 from pyraf import iraf
 import pyfits
 # why won't logging work in PyRAF :(
-from aotools.util import debug, info, warn, error, combine_cube_frames
-# from aotools.util import frames_to_cube
+from aotools.util import debug, info, warn, error, combine_cube_frames_to_cubes
 
-import logging
+def exposure_range_pairs(oldexposure, newexposure, fromidx, toidx, stride=0):
+    """
+    One-indexed, inclusive frame ranges that combine frames of
+    `oldexposure` into frames of `newexposure` between frames `fromidx`
+    and `toidx`, starting a new combined frame every `stride` frames
+    (default: 0, meaning back to back, with no overlap)
+    """
+    # round, not truncate: 0.3 / 0.1 is 2.9999999999999996
+    ratio = newexposure / oldexposure
+    frames_per_combined = int(round(ratio))
+    epsilon = abs(ratio - frames_per_combined)
+    if epsilon > 0.01:
+        warn("New exposure is not an integer multiple of old exposure, rounding to", frames_per_combined)
+    assert frames_per_combined > 1, "Only one old frame per combined frame; this is probably not what you want"
+    if stride < 1:
+        stride = frames_per_combined
+
+    total_frames = toidx - fromidx + 1
+    assert total_frames >= frames_per_combined, ("Only {0} frames in range, need {1} for one "
+        "combined exposure".format(total_frames, frames_per_combined))
+    leftover = (total_frames - frames_per_combined) % stride
+    if leftover != 0:
+        warn("Total frames in range (", total_frames, ") don't fill a whole number of combined exposures "
+             "of", frames_per_combined, "frames every", stride, "frames, so", leftover,
+             "frames from the end of the range will be left off.")
+    return [(start, start + frames_per_combined - 1)
+            for start in range(fromidx, toidx - frames_per_combined + 2, stride)]
 
-def aoavgcube(cubefile, outfile, newexposure, fromidx=1, toidx=None):
+def aoavgcube(cubefile, outfile, newexposure, fromidx=1, toidx=None, stride=0):
     """
     Combine (without rejection) many short exposures in a data cube
     to approximate a "seeing disk" from a longer integration time.
     
     cubefile - input data cube path
-    outfile - output data cube path
+    outfile - output data cube path (with several exposure times, the
+              exposure time is added to the name of each cube)
+    newexposure - new exposure time, or comma-separated list of new
+                  exposure times, in seconds
     fromidx - 1-based index of start of combining range (default: 1)
     toidx - 1-based index of end of range (default: None, end of cube)
+    stride - frames between the starts of consecutive combined frames
+             (default: 0, meaning one combined exposure, no overlap)
     """
-    newexposure = float(newexposure)
-    ffile = pyfits.open(cubefile)
-    header = ffile[0].header
-    data = ffile[0].data
+    newexposures = [float(exposure) for exposure in str(newexposure).split(',')]
+    header = pyfits.getheader(cubefile)
 
     if 'EXPOSURE' in header.keys():
         oldexposure = float(header['EXPOSURE'])
@@ -32,54 +58,31 @@ def aoavgcube(cubefile, outfile, newexposure, fromidx=1, toidx=None):
     else:
         raise Exception("No exposure time value found in the datacube header!")
 
-    assert newexposure > oldexposure, ("Can't get a shorter exposure time by combining frames! "
-        "oldexposure {0} > newexposure {1}".format(oldexposure, newexposure))
-
-    frames_per_combined = int(newexposure / oldexposure)
-    epsilon = (newexposure / oldexposure) - int(newexposure / oldexposure)
-    if epsilon > 0.01:
-        warn("New exposure is not an integer multiple of old exposure, rounding to", frames_per_combined)
-    assert frames_per_combined > 1, "Only one old frame per combined frame; this is probably not what you want"
-
-    if toidx <= fromidx:
+    nframes = header['NAXIS3'] if header['NAXIS'] == 3 else 1
+    if toidx is None or toidx <= fromidx:
         # use entire cube
-        toidx = data.shape[0]
+        toidx = nframes
     else:
-        assert toidx <= data.shape[0], "toidx ({0}) > number of frames ({1})".format(toidx, data.shape[0])
-    assert data.shape[0] > 1, "Only one frame found! Is this a data cube?"
-
-    total_frames = toidx - fromidx
+        assert toidx <= nframes, "toidx ({0}) > number of frames ({1})".format(toidx, nframes)
+    assert nframes > 1, "Only one frame found! Is this a data cube?"
     debug("toidx=",toidx,"fromidx=",fromidx)
 
-    if total_frames % frames_per_combined != 0:
-        warn("Total frames in range (toidx - fromidx =", toidx - fromidx, ") is not an integer multiple "
-             "of the number of frames per combined exposure (", frames_per_combined,
-             ") so", total_frames % frames_per_combined, "frames from the end of "
-             "the range will be left off.")
-        toidx = toidx - (total_frames % frames_per_combined)
-        total_frames = toidx - fromidx
-
-    total_combined_frames = int(total_frames / frames_per_combined)
-    info("Output data cube will have", total_combined_frames, "total frames of", newexposure, "sec exposure")
+    outputs = []
+    base, ext = os.path.splitext(outfile)
+    for exposure in newexposures:
+        assert exposure > oldexposure, ("Can't get a shorter exposure time by combining frames! "
+            "oldexposure {0} > newexposure {1}".format(oldexposure, exposure))
+        range_pairs = exposure_range_pairs(oldexposure, exposure, fromidx, toidx, stride)
+        if len(newexposures) > 1:
+            exposure_outfile = "{0}_{1}s{2}".format(base, exposure, ext)
+        else:
+            exposure_outfile = outfile
+        info("Output data cube", exposure_outfile, "will have", len(range_pairs), "total frames of", exposure, "sec exposure")
+        outputs.append((exposure_outfile, range_pairs))
     info("Processing input data cube frames", fromidx, "to", toidx)
-    target_dir = tempfile.mkdtemp()
-    info("Created working directory {0} for intermediate data".format(target_dir))
-
-    try:
-        range_pairs = list((
-            fromidx + n * frames_per_combined,
-            fromidx + (n+1) * frames_per_combined - 1
-        ) for n in range(0, total_combined_frames))
-        
-        frame_paths = combine_cube_frames(cubefile, range_pairs, target_dir)
-        # frames_to_cube(frame_paths, outfile)
-    finally:
-        # Don't leave clutter if the task fails
-        # shutil.rmtree(target_dir)
-        info("Removed working directory {0}".format(target_dir))
 
-# def frames_to_cube(frames, outfile):
-    
+    # one pass over the cube for every exposure time
+    combine_cube_frames_to_cubes(cubefile, outputs, combine='sum')
 
 parfile = iraf.osfn("aotools$aoavgcube.par")
 t = iraf.IrafTaskFactory(taskname="aoavgcube", value=parfile, function=aoavgcube)
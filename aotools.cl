@@ -1,5 +1,6 @@
 pyexecute("aotools$addpath.py",verbose=no)
 pyexecute("aotools$aoavgcube.py",verbose=no)
+pyexecute("aotools$centroidcube.py",verbose=no)
 pyexecute("aotools$cubeflatfield.py",verbose=no)
 pyexecute("aotools$cubestack.py",verbose=no)
 pyexecute("aotools$cubemedian.py",verbose=no)
@@ -7,6 +8,7 @@ pyexecute("aotools$cubetoframes.py",verbose=no)
 pyexecute("aotools$findbright.py",verbose=no)
 pyexecute("aotools$strehlframe.py",verbose=no)
 pyexecute("aotools$strehlcube.py",verbose=no)
+pyexecute("aotools$strehlfollow.py",verbose=no)
 pyexecute("aotools$photstrehl.py",verbose=no)
 pyexecute("aotools$photstrehlframe.py",verbose=no)
 pyexecute("aotools$pngtocube.py",verbose=no)
@@ -0,0 +1,206 @@
+import math
+import pyfits
+import numpy as np
+import scipy.ndimage
+# why won't logging work in PyRAF :(
+from aotools.util import debug, info, warn, error, iter_cube_chunks, chunk_frame_count, DEFAULT_CHUNK_MB
+
+CENTROID_METHODS = ('moment', 'gaussian', 'quadratic', 'xcorr')
+
+# columns of a center table, one row per frame; like a daofind .coo
+# file, centers are 1-indexed IRAF coordinates
+CENTER_DTYPE = [
+    ('FRAME', np.int64),
+    ('XCENTER', np.float64),
+    ('YCENTER', np.float64),
+]
+
+def _frame_argmax(stack):
+    """(rows, cols) of the maximum of each frame of a (frames, rows, cols) stack"""
+    nframes, nrows, ncols = stack.shape
+    flat = np.argmax(stack.reshape(nframes, -1), axis=1)
+    return flat // ncols, flat % ncols
+
+def _neighborhoods(stack, rows, cols, halfwidth):
+    """
+    (frames, 2 * halfwidth + 1, 2 * halfwidth + 1) cutouts of `stack`,
+    one per frame, around (rows[i], cols[i]), moved as needed to stay
+    on the frame. Returns (cutouts, top, left), where top and left are
+    the frame coordinates of each cutout's first pixel.
+    """
+    nframes, nrows, ncols = stack.shape
+    size = 2 * halfwidth + 1
+    top = np.clip(rows - halfwidth, 0, nrows - size)
+    left = np.clip(cols - halfwidth, 0, ncols - size)
+    offsets = np.arange(size)
+    frame_idx = np.arange(nframes)[:, np.newaxis, np.newaxis]
+    row_idx = (top[:, np.newaxis] + offsets)[:, :, np.newaxis]
+    col_idx = (left[:, np.newaxis] + offsets)[:, np.newaxis, :]
+    return stack[frame_idx, row_idx, col_idx], top, left
+
+# least-squares fit of a + b x + c y + d x^2 + e x y + f y^2 to a 3x3
+# neighborhood, as a matrix to multiply the 9 values by
+_QUAD_Y, _QUAD_X = [offsets.ravel().astype(np.float64) for offsets in np.mgrid[-1:2, -1:2]]
+_QUAD_FIT = np.linalg.pinv(np.column_stack([
+    np.ones(9), _QUAD_X, _QUAD_Y, _QUAD_X**2, _QUAD_X * _QUAD_Y, _QUAD_Y**2
+]))
+
+def _quadratic_vertex(values):
+    """
+    Offsets (dx, dy) from the middle pixel to the maximum of the 2D
+    quadratic fit to each (3, 3) neighborhood of `values`, clipped to
+    one pixel; (0, 0) where the fit has no maximum
+    """
+    a, b, c, d, e, f = np.dot(_QUAD_FIT, values.reshape(len(values), 9).T)
+    # where the gradient b + 2 d x + e y, c + e x + 2 f y vanishes
+    det = 4.0 * d * f - e**2
+    is_max = (det > 0) & (d < 0)
+    det = np.where(is_max, det, 1.0)
+    dx = np.where(is_max, (e * c - 2.0 * f * b) / det, 0.0)
+    dy = np.where(is_max, (e * b - 2.0 * d * c) / det, 0.0)
+    return np.clip(dx, -1.0, 1.0), np.clip(dy, -1.0, 1.0)
+
+def cross_correlate(stack, template):
+    """
+    Circular cross-correlation of each frame of `stack` with
+    `template` through FFTs of the whole stack at once. The result has
+    the shape of `stack` and peaks where the template's middle pixel
+    sits when it best matches the frame.
+    """
+    nframes, nrows, ncols = stack.shape
+    trows, tcols = template.shape
+    if trows > nrows or tcols > ncols:
+        raise ValueError("Template {0} is larger than the {1} frames".format(template.shape, (nrows, ncols)))
+    # template with its middle pixel moved to (0, 0)
+    kernel = np.zeros((nrows, ncols))
+    kernel[:trows, :tcols] = template
+    kernel = np.roll(np.roll(kernel, -(trows // 2), axis=0), -(tcols // 2), axis=1)
+    spectrum = np.fft.rfft2(stack, axes=(1, 2)) * np.conj(np.fft.rfft2(kernel))
+    return np.fft.irfft2(spectrum, s=(nrows, ncols), axes=(1, 2))
+
+def psf_template(psf, halfwidth):
+    """
+    (2 * halfwidth + 1) square cutout of an ideal PSF Frame (see
+    psfcache.ideal_psf), shifted so the PSF's center falls on the
+    middle pixel, for cross-correlation centroiding
+    """
+    col, row = psf.center
+    icol, irow = int(round(col)), int(round(row))
+    # a margin for the interpolation to draw on
+    pad = halfwidth + 2
+    cutout = psf.data[irow - pad:irow + pad + 1, icol - pad:icol + pad + 1]
+    shifted = scipy.ndimage.shift(cutout, (irow - row, icol - col), mode='nearest')
+    return shifted[2:-2, 2:-2]
+
+def centroid_stack(stack, method='moment', window=5, fwhmpsf=2.5, template=None):
+    """
+    Sub-pixel centers of the brightest source in each frame of a
+    (frames, rows, cols) stack (or a single 2D frame), all frames at
+    once. The source is first located at the peak of each frame
+    smoothed by a Gaussian of `fwhmpsf` (so lone hot pixels don't win),
+    or for 'xcorr' the peak of its cross-correlation with `template`,
+    after subtracting the frame's median as the background. Then:
+
+      'moment' - first moment of the background subtracted pixels in a
+                 (2 * window + 1) square box around the peak
+      'gaussian' - vertex of a 2D quadratic fit to the logarithm of the
+                   smoothed 3x3 neighborhood of the peak (a 2D Gaussian)
+      'quadratic' - vertex of a 2D quadratic fit to that neighborhood
+      'xcorr' - vertex of a 2D quadratic fit to the cross-correlation
+                peak
+
+    template - 2D image to cross-correlate with for 'xcorr', middle
+               pixel on the center, e.g. from psf_template (default:
+               None, a Gaussian of fwhmpsf)
+
+    Returns (xcenter, ycenter) arrays in 1-indexed IRAF coordinates.
+    """
+    if method not in CENTROID_METHODS:
+        raise ValueError("Unknown centroid method {0}".format(method))
+    stack = np.asarray(stack, dtype=np.float64)
+    if stack.ndim == 2:
+        stack = stack[np.newaxis]
+    nframes, nrows, ncols = stack.shape
+    if 2 * window + 1 > min(nrows, ncols):
+        raise ValueError("Centroid window of {0} px doesn't fit on {1} frames".format(window, (nrows, ncols)))
+    background = np.median(stack.reshape(nframes, -1), axis=1)[:, np.newaxis, np.newaxis]
+    if method == 'xcorr' and template is not None:
+        surface = cross_correlate(stack - background, template)
+    else:
+        sigma = fwhmpsf / (2.0 * math.sqrt(2.0 * math.log(2.0)))
+        surface = scipy.ndimage.gaussian_filter(stack - background, sigma=(0, sigma, sigma), mode='nearest')
+    rows, cols = _frame_argmax(surface)
+
+    if method == 'moment':
+        cutouts, top, left = _neighborhoods(stack, rows, cols, window)
+        weights = np.clip(cutouts - background, 0.0, None)
+        total = np.sum(weights, axis=(1, 2))
+        offsets = np.arange(2 * window + 1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            y = top + np.dot(np.sum(weights, axis=2), offsets) / total
+            x = left + np.dot(np.sum(weights, axis=1), offsets) / total
+        # nothing above the background: fall back to the peak
+        y = np.where(total > 0, y, rows)
+        x = np.where(total > 0, x, cols)
+    else:
+        peaks, top, left = _neighborhoods(surface, rows, cols, 1)
+        if method == 'gaussian':
+            # a Gaussian is a quadratic in log space
+            floor = np.max(peaks, axis=(1, 2))[:, np.newaxis, np.newaxis] * 1e-6
+            peaks = np.log(np.maximum(peaks, np.maximum(floor, np.finfo(np.float64).tiny)))
+        dx, dy = _quadratic_vertex(peaks)
+        x, y = left + 1 + dx, top + 1 + dy
+    return x + 1.0, y + 1.0
+
+def centroid_cube(cubefile, range_pairs, method='moment', window=5, fwhmpsf=2.5, template=None,
+        chunk_mb=DEFAULT_CHUNK_MB):
+    """
+    Center table (see CENTER_DTYPE) for the frames in the one-indexed,
+    inclusive ranges in `range_pairs`, centroided with centroid_stack a
+    memory-mapped chunk of frames at a time.
+
+    method, window, fwhmpsf, template - as for centroid_stack
+    chunk_mb - approximate memory budget for each chunk (default: 64)
+    """
+    header = pyfits.getheader(cubefile)
+    nframes = header['NAXIS3'] if header['NAXIS'] > 2 else 1
+    # smoothing or correlating takes several copies of a chunk
+    chunk_frames = chunk_frame_count((header['NAXIS2'], header['NAXIS1']), chunk_mb / 4.0)
+    table = np.zeros(sum(toidx - fromidx + 1 for fromidx, toidx in range_pairs), dtype=CENTER_DTYPE)
+    row = 0
+    for fromidx, toidx in range_pairs:
+        if fromidx < 1 or toidx > nframes:
+            raise ValueError("Frame range {0}-{1} is outside the cube "
+                             "(frames 1-{2})".format(fromidx, toidx, nframes))
+        for start, chunk in iter_cube_chunks(cubefile, chunk_frames, frame_range=(fromidx - 1, toidx)):
+            xcenter, ycenter = centroid_stack(chunk, method, window, fwhmpsf, template)
+            count = len(xcenter)
+            table['FRAME'][row:row + count] = np.arange(start + 1, start + count + 1)
+            table['XCENTER'][row:row + count] = xcenter
+            table['YCENTER'][row:row + count] = ycenter
+            row += count
+        debug("centroided frames", fromidx, "to", toidx, "of", cubefile, "by", method)
+    return table
+
+def write_center_table(filename, table):
+    """Write a center table as tab-separated text with a header line"""
+    np.savetxt(filename, np.column_stack((table['FRAME'], table['XCENTER'], table['YCENTER'])),
+        fmt=('%d', '%.6f', '%.6f'), delimiter='\t', header='\t'.join(name for name, dtype in CENTER_DTYPE))
+    debug("Wrote file", filename)
+
+def read_center_table(filename):
+    """Read a center table written by write_center_table"""
+    table = np.genfromtxt(filename, dtype=CENTER_DTYPE)
+    return np.atleast_1d(table)
+
+def centers_by_frame(table, range_pairs):
+    """
+    Map each frame number in `range_pairs` to its (xcenter, ycenter)
+    from a center table, raising an error if any are missing
+    """
+    centers = dict((int(frame_num), (float(x), float(y)))
+                   for frame_num, x, y in zip(table['FRAME'], table['XCENTER'], table['YCENTER']))
+    missing = [i for fromidx, toidx in range_pairs for i in range(fromidx, toidx + 1) if i not in centers]
+    if missing:
+        raise RuntimeError("No centers for {0} frames (first: {1})".format(len(missing), missing[0]))
+    return centers
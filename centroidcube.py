@@ -0,0 +1,19 @@
+import os.path
+import numpy
+import pyfits
+from pyraf import iraf
+from aotools.util import debug, info, warn, error, parse_ranges
+from aotools.centroid import centroid_cube, write_center_table
+
+def centroidcube(cubefile, rangespec, outfile, method='moment', window=5, fwhmpsf=2.5,
+        template='', chunk_mb=64):
+    if not os.path.exists(cubefile):
+        raise RuntimeError("No file named {0}".format(cubefile))
+    template_data = pyfits.getdata(template).astype(numpy.float64) if template else None
+    table = centroid_cube(cubefile, parse_ranges(rangespec), method=method, window=window,
+        fwhmpsf=fwhmpsf, template=template_data, chunk_mb=chunk_mb)
+    write_center_table(outfile, table)
+    info("Wrote centers for", len(table), "frames to", outfile)
+
+parfile = iraf.osfn("aotools$centroidcube.par")
+t = iraf.IrafTaskFactory(taskname="centroidcube", value=parfile, function=centroidcube)
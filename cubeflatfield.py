@@ -2,18 +2,26 @@ import os.path
 import numpy
 import pyfits
 from pyraf import iraf
-from aotools.util import debug, info, warn, error, parse_ranges
+from aotools.util import debug, info, warn, error, parse_ranges, stream_cube, reciprocal_flat
 
-def cubeflatfield(cubefile, flatfile, outfile):
-    flatdata = pyfits.getdata(flatfile)
-    hdulist = pyfits.open(cubefile)
-    cubedata = hdulist[0].data
+def cubeflatfield(cubefile, flatfile, outfile, chunk_mb=64, outtype='float32', divzero=0.0):
+    inverse_flat, bad = reciprocal_flat(pyfits.getdata(flatfile), dtype=outtype)
+    if numpy.any(bad):
+        warn(numpy.sum(bad), "pixels of the flat are zero, negative or not finite; setting them to", divzero)
+    buffers = {}
 
-    for idx in xrange(0, cubedata.shape[0]):
-        cubedata[idx] = cubedata[idx] / flatdata
+    def divide(chunk, start):
+        # the writer is done with the last chunk by now, so reuse its buffer
+        if chunk.shape not in buffers:
+            buffers.clear()
+            buffers[chunk.shape] = numpy.empty(chunk.shape, dtype=outtype)
+        out = buffers[chunk.shape]
+        numpy.multiply(chunk, inverse_flat, out=out, casting='unsafe')
+        out[:,bad] = divzero
+        return out
 
-    hdulist.writeto(outfile)
+    stream_cube(cubefile, outfile, divide, chunk_mb=chunk_mb)
     info("Wrote to", outfile)
 
 parfile = iraf.osfn("aotools$cubeflatfield.par")
-t = iraf.IrafTaskFactory(taskname="cubeflatfield", value=parfile, function=cubeflatfield)
\ No newline at end of file
+t = iraf.IrafTaskFactory(taskname="cubeflatfield", value=parfile, function=cubeflatfield)
@@ -2,11 +2,10 @@ import os.path
 import numpy
 import pyfits
 from pyraf import iraf
-from aotools.util import debug, info, warn, error, parse_ranges
+from aotools.util import debug, info, warn, error, parse_ranges, cube_median
 
-def cubemedian(infile, outfile, exposure):
-    datacube = pyfits.getdata(infile)
-    median_frame = numpy.median(datacube, axis=0)
+def cubemedian(infile, outfile, exposure, chunk_mb=64):
+    median_frame = cube_median(infile, chunk_mb=chunk_mb)
     hdu = pyfits.PrimaryHDU(median_frame)
     hdu.header['EXPOSURE'] = exposure
     hdu.writeto(outfile)
@@ -4,7 +4,7 @@ from aotools.util import debug, info, warn, error, combine_cube_frames
 import os.path
 from pyraf import iraf
 
-def cubestack(cubefile, rangespec='', clobber=False):
+def cubestack(cubefile, rangespec='', clobber=False, combine='sum'):
     ranges = []
     for rangestr in rangespec.split(','):
         a, b = rangestr.split('-')
@@ -16,7 +16,7 @@ def cubestack(cubefile, rangespec='', clobber=False):
     debug("target:", target_dir)
     
     tmp_target_dir = tempfile.mkdtemp()
-    outimgs = combine_cube_frames(cubefile, ranges, tmp_target_dir)
+    outimgs = combine_cube_frames(cubefile, ranges, tmp_target_dir, combine=combine)
     if os.path.isdir(target_dir):
         debug("target dir exists, removing", target_dir)
         shutil.rmtree(target_dir)
@@ -4,10 +4,10 @@ import numpy as np
 # why won't logging work in PyRAF :(
 from aotools.util import debug, info, warn, error, parse_coo_file
 
-from aotools.strehl import daofind_brightest
+from aotools.strehl import find_brightest
 
-def findbright(image, fwhmpsf, threshold):
-    bright = daofind_brightest(image, fwhmpsf, threshold)
+def findbright(image, fwhmpsf, threshold, finder='native'):
+    bright = find_brightest(image, fwhmpsf, threshold, finder=finder)
     print "Brightest source:"
     print "XCENTER\tYCENTER\tMAG\tID"
     print "{0}\t{1}\t{2}\t{3}".format(bright['XCENTER'], bright['YCENTER'], bright['MAG'], bright['ID'])
@@ -1,28 +1,34 @@
 from pyraf import iraf
 import math
 import os
-import re
-import uuid
-import shutil
 import time
-import tempfile
 import pyfits
 import numpy as np
 import matplotlib
 matplotlib.use('agg') # cannot import pyplot within pyraf without this
 from matplotlib import pyplot as plt
 # why won't logging work in PyRAF :(
-from aotools.util import debug, info, warn, error, write_table, parse_ranges
+from aotools.util import (debug, info, warn, error, write_table, parse_ranges, file_checksum,
+    iter_cube_frames
+)
 from aotools.strehl import (Frame, generate_pupil, generate_circular_mask, 
-    generate_psf_full, compute_psf_scale, generate_scaled_psf, first_min_from_core, avgrow,
-    avgrow_median_subtract, phot_curve_of_growth, profile_from_growthcurve,
-    daofind_brightest
+    generate_psf_full, compute_psf_scale, generate_scaled_psf, plate_scale, first_min_from_core, avgrow,
+    avgrow_median_subtract, exact_curve_of_growth, profile_from_growthcurve,
+    batch_profile_from_growthcurve, batch_strehl, SourceTracker, TRACK_FIXED, TRACK_CENTROID, track_frames
+)
+from aotools.psfcache import ideal_psf
+from aotools.centroid import centroid_cube, psf_template, read_center_table, centers_by_frame
+from aotools.series import (StrehlSeriesWriter, write_strehl_series_text, analyze_frames,
+    checkpoint_key, discard_checkpoint
 )
-from aotools.cubetoframes import split_frames
 
 def photstrehl(cubefile, rangespec, primary, secondary, dimension, f_number,
         pixel_scale, lambda_mean, growth_step, normalize_at, find_source, xcenter, ycenter,
-        fwhmpsf, threshold, quiet):
+        fwhmpsf, threshold, quiet, psfcache=True, psfengine='fft', oversample=1,
+        pupilfile='', spiders=0, spider_width=0.0, fftthreads=1, fftsingle=False,
+        finder='native', track=False, track_window=10, workers=1,
+        seriesformat='text', checkpoint=True, checkpoint_every=100,
+        centroid='finder', centerfile=''):
     start_time = time.time()
     info("Started at:", start_time)
     if not os.path.exists(cubefile):
@@ -30,27 +36,7 @@ def photstrehl(cubefile, rangespec, primary, secondary, dimension, f_number,
     cubefile_base = os.path.splitext(os.path.basename(cubefile))[0]
     # I: compute ideal psf
     
-    scale_to_physical, plate_scale_px, min_radius_real = compute_psf_scale(
-        dimension,
-        primary,
-        secondary,
-        f_number,
-        lambda_mean,
-        pixel_scale
-    )
-    
-    info("The radius of the first minimum in physical pixels is", min_radius_real, "px")
-    
-    scaled_psf, scaled_psf_ctr, max_aperture_radius = generate_scaled_psf(
-        dimension,
-        primary,
-        secondary,
-        scale_to_physical
-    )
-    
-    # wrap psf in a frame
-    psf = Frame(scaled_psf, scaled_psf_ctr)
-    
+    plate_scale_px = plate_scale(f_number, pixel_scale)
     if normalize_at != 0:
         max_extent_px = normalize_at
         debug("Rescaling to max integrated flux @ r=", max_extent_px, "pixels")
@@ -58,98 +44,124 @@ def photstrehl(cubefile, rangespec, primary, secondary, dimension, f_number,
         max_extent_px = 2.5 / plate_scale_px # After 2.5" we're almost certainly measuring noise
         debug("after 2.5'' or", max_extent_px, "px we'll be almost certainly measuring noise")
     growth_max = max_extent_px + growth_step * 3 # do 3 steps beyond the 2.5" mark
-    assert growth_max < max_aperture_radius, "Curve of Growth won't fit on PSF frame with this max extent"
     
-    # precompute CoG and profile to be rescaled later
-    
-    # phot CoG needs a FITS file, so write one:
-    psftmpfilename = os.path.abspath('./{0}.fits'.format(uuid.uuid1()))
-    hdu = pyfits.PrimaryHDU(psf.data)
-    hdu.writeto(psftmpfilename)
-    debug("psf FITS file temporarily stored in", psftmpfilename)
+    # ideal psf, with CoG and profile precomputed to be rescaled later
+    psf, scale_to_physical, plate_scale_px, min_radius_real, max_aperture_radius = ideal_psf(
+        dimension,
+        primary,
+        secondary,
+        f_number,
+        pixel_scale,
+        lambda_mean,
+        growth_step,
+        method='exact',
+        max_aperture=growth_max,
+        engine=psfengine,
+        oversample=oversample,
+        spiders=spiders,
+        spider_width=spider_width,
+        pupilfile=pupilfile,
+        fft_threads=fftthreads,
+        single=fftsingle,
+        quiet=quiet,
+        use_cache=psfcache
+    )
     
-    phot_curve_of_growth(psf, psftmpfilename, growth_max, step=growth_step, quiet=quiet, fitsky=False)
-    profile_from_growthcurve(psf)
+    info("The radius of the first minimum in physical pixels is", min_radius_real, "px")
+    assert growth_max < max_aperture_radius, "Curve of Growth won't fit on PSF frame with this max extent"
     
     # II: analyze images
     
-    # functions to rescale our PSF Frame computed values
-    # to physical counts
-    
-    def max_flux(frame):
-        """Frame max integrated flux (for a radius less than 2.5'')"""
-        return np.max(frame.fluxes[frame.radii <= max_extent_px])
-    
-    def scale_psf_fluxes(frame, psf):
-        """
-        Returns a profile and curve of growth values for the ideal PSF
-        scaled such that the total integrated flux is equivalent to the
-        maximum flux in the frame passed as the first argument.
-        """
-        scale_factor = (max_flux(frame) / max_flux(psf))
-        return psf.profile * scale_factor, psf.fluxes * scale_factor
-
-    tmp_target_dir = tempfile.mkdtemp()
     ranges = parse_ranges(rangespec)
-    debug("splitting ranges", ranges)
-    fits_frames = split_frames(cubefile, ranges, tmp_target_dir)
-    debug("working in", tmp_target_dir, "with frames", fits_frames)
 
     # set up array to hold each frame's analysis data
     radii_count = psf.radii.shape[0]
-    frame_count = len(fits_frames)
+    frame_count = sum(toidx - fromidx + 1 for fromidx, toidx in ranges)
     shape = (frame_count, 5, radii_count)
     analysis_frames = np.zeros(shape)
     # [cog x count, prof x count, ideal x count, idealprof x count, strehl x count] x frames
     
-    strehl_rows = []
-    
-    for fits_frame in fits_frames:
-        # this is slightly dumb... parse the frame # out of the filename
-        frame_num = int(re.findall(r'\d+', os.path.basename(fits_frame))[0])
-        if find_source:
-            bright = daofind_brightest(fits_frame, fwhmpsf, threshold)
-            center_col, center_row = bright['XCENTER'], bright['YCENTER']
-            debug("frame #", frame_num, "has brightest at", center_col, center_row)
-            center_coords = (float(center_col), float(center_row))
-            frame = Frame(pyfits.getdata(fits_frame), center_coords)
-        else:
-            center_coords = (float(xcenter), float(ycenter))
-            frame = Frame(pyfits.getdata(fits_frame), center_coords)
+    # centers for every frame up front, from a table or batch centroiding
+    frame_centers = None
+    if centerfile:
+        frame_centers = centers_by_frame(read_center_table(centerfile), ranges)
+    elif centroid != 'finder':
+        # cross-correlate with the ideal PSF core, out to the first minimum
+        template = psf_template(psf, int(math.ceil(min_radius_real))) if centroid == 'xcorr' else None
+        frame_centers = centers_by_frame(centroid_cube(cubefile, ranges, method=centroid,
+            window=int(math.ceil(2 * fwhmpsf)), fwhmpsf=fwhmpsf, template=template), ranges)
+    
+    # tracking carries state from frame to frame, so follow the source
+    # through all the frames in order here rather than in the workers,
+    # whose chunks would each start over
+    frame_tracks = None
+    if frame_centers is None and find_source and track:
+        frame_tracks = track_frames(iter_cube_frames(cubefile, ranges), fwhmpsf, threshold,
+            window=track_window, finder=finder,
+            image_section=lambda frame_num: "{0}[*,*,{1}]".format(cubefile, frame_num))
+    
+    def make_worker():
+        # without tracking, each frame gets its own full-frame search
+        tracker = SourceTracker(fwhmpsf, threshold, window=0, finder=finder)
+        def analyze(frame_num, frame_data):
+            if frame_centers is not None:
+                center_coords = frame_centers[frame_num]
+                track_flag = TRACK_CENTROID
+            elif frame_tracks is not None:
+                center_coords, track_flag = frame_tracks[frame_num]
+            elif find_source:
+                # daofind can read the frame through an image section, no need to split the cube
+                image_section = "{0}[*,*,{1}]".format(cubefile, frame_num)
+                bright, track_flag = tracker.locate(frame_data, image_section)
+                center_col, center_row = bright['XCENTER'], bright['YCENTER']
+                debug("frame #", frame_num, "has brightest at", center_col, center_row, "(track flag", track_flag, ")")
+                center_coords = (float(center_col), float(center_row))
+            else:
+                center_coords = (float(xcenter), float(ycenter))
+                track_flag = TRACK_FIXED
+            # center_coords are 1-indexed IRAF coordinates, as phot used them
+            frame = Frame(frame_data, (center_coords[0] - 1.0, center_coords[1] - 1.0))
         
-        debug("loaded frame from", fits_frame)
-    
-        # subtract median row to handle light/charge leakage biasing measurements
-        exclude_from, exclude_to = frame.ybounds(r=int(max_extent_px)) # exclude region of max_extent_px around center of frame
-        avgrow_median_subtract(frame, exclude_from, exclude_to)
-        debug("median subtracted frame")
-        phot_curve_of_growth(frame, fits_frame, growth_max, step=growth_step, quiet=quiet, fitsky=True)
-        debug("curve of growth generated")
-        profile_from_growthcurve(frame)
-        debug("profile generated")
-    
-        # scale psf.fluxes and psf.profile to a max value determined from frame
-        ideal_profile, ideal_fluxes = scale_psf_fluxes(frame, psf)
-        strehls_for_all_radii = frame.fluxes / ideal_fluxes
-        strehl_rows.append((frame_num, center_coords, strehls_for_all_radii))
-
-    outfile = "{0}_{1}_strehlseries.txt".format(cubefile_base, rangespec)
-    debug("writing strehl series to", outfile)
-    with open(outfile, 'w') as f:
-        f.write("# columns 2 and up are the pixel radii at which we computed the Strehl ratio\n")
-        f.write("# frameidx\txcenter\tycenter\t")
-        f.write('\t'.join(map(str, psf.radii)))
-        f.write('\n')
-        for idx, center, ratios in strehl_rows:
-            f.write(str(idx))
-            f.write('\t')
-            f.write('\t'.join(map(str, center)))
-            f.write('\t')
-            f.write('\t'.join(map(str, ratios)))
-            f.write('\n')
-
-    debug("removing exploded cube from", tmp_target_dir)
-    shutil.rmtree(tmp_target_dir)
+            # subtract median row to handle light/charge leakage biasing measurements
+            exclude_from, exclude_to = frame.ybounds(r=int(max_extent_px)) # exclude region of max_extent_px around center of frame
+            avgrow_median_subtract(frame, exclude_from, exclude_to)
+            debug("median subtracted frame")
+            exact_curve_of_growth(frame, growth_max, step=growth_step, quiet=quiet, fitsky=True)
+            debug("curve of growth generated")
+            return (frame_num, center_coords, track_flag, frame.fluxes, frame.npix)
+        return analyze
+    
+    series_base = "{0}_{1}_strehlseries".format(cubefile_base, rangespec)
+    checkpoint_path = series_base + "_checkpoint" if checkpoint else None
+    key = checkpoint_key(cubefile, dict(
+        primary=primary, secondary=secondary, dimension=dimension, f_number=f_number,
+        pixel_scale=pixel_scale, lambda_mean=lambda_mean, growth_step=growth_step,
+        normalize_at=normalize_at, find_source=find_source, xcenter=xcenter, ycenter=ycenter,
+        fwhmpsf=fwhmpsf, threshold=threshold, psfengine=psfengine, pupilfile=pupilfile,
+        spiders=spiders, spider_width=spider_width, finder=finder, track=track,
+        track_window=track_window, centroid=centroid,
+        centerfile=file_checksum(centerfile) if centerfile else ''
+    )) if checkpoint else None
+    frame_nums, centers, track_flags, fluxes, npix = analyze_frames(cubefile, ranges, make_worker, psf.radii,
+        workers=workers, checkpoint_path=checkpoint_path, key=key, batch_frames=checkpoint_every)
+    
+    # profiles, scaled ideal PSF and Strehl ratios for all frames at once
+    profiles, profile_npix = batch_profile_from_growthcurve(fluxes, npix)
+    strehls, ideal_fluxes, ideal_profiles = batch_strehl(fluxes, psf, max_extent_px)
+    for idx, values in enumerate((fluxes, profiles, ideal_fluxes, ideal_profiles, strehls)):
+        analysis_frames[:,idx,:] = values
+    analysis_outfile = "{0}_{1}_analysis.npy".format(cubefile_base, rangespec)
+    debug("writing per-frame analysis matrix to", analysis_outfile)
+    np.save(analysis_outfile, analysis_frames)
+    if seriesformat == 'npy':
+        debug("writing binary strehl series to", series_base)
+        with StrehlSeriesWriter(series_base, psf.radii) as writer:
+            writer.append(frame_nums, centers, track_flags, strehls, fluxes)
+    else:
+        debug("writing strehl series to", series_base + ".txt")
+        write_strehl_series_text(series_base + ".txt", frame_nums, centers, track_flags, psf.radii, strehls)
+    if checkpoint:
+        discard_checkpoint(checkpoint_path)
 
     info("Completed at:", time.time())
     info("Total time:", time.time() - start_time)
@@ -3,7 +3,6 @@ import math
 import os
 import time
 import pyfits
-import uuid
 import numpy as np
 import matplotlib
 matplotlib.use('agg') # cannot import pyplot within pyraf without this
@@ -11,46 +10,29 @@ from matplotlib import pyplot as plt
 # why won't logging work in PyRAF :(
 from aotools.util import debug, info, warn, error, write_table
 from aotools.strehl import (Frame, generate_pupil, generate_circular_mask, 
-    generate_psf_full, compute_psf_scale, generate_scaled_psf, 
-    first_min_from_core, avgrow, avgrow_median_subtract, phot_curve_of_growth,
-    profile_from_growthcurve, plot_with_arcseconds, daofind_brightest
+    generate_psf_full, compute_psf_scale, generate_scaled_psf, plate_scale, 
+    first_min_from_core, avgrow, avgrow_median_subtract, exact_curve_of_growth,
+    profile_from_growthcurve, plot_with_arcseconds, find_brightest
 )
+from aotools.psfcache import ideal_psf
 
 def photstrehlframe(image, primary, secondary, dimension, f_number, pixel_scale,
         lambda_mean, growth_step, normalize_at, find_source, xcenter, ycenter, fwhmpsf,
-        threshold, quiet):
+        threshold, quiet, psfcache=True, psfengine='fft', oversample=1,
+        pupilfile='', spiders=0, spider_width=0.0, fftthreads=1, fftsingle=False,
+        finder='native'):
     start_time = time.time()
     info("Started at:", start_time)
     if not os.path.exists(image):
         raise RuntimeError("No file named {0}".format(image))
     # Were we given coordinates, or do we need to find the source?
     if find_source:
-        bright = daofind_brightest(image, fwhmpsf, threshold)
+        bright = find_brightest(image, fwhmpsf, threshold, finder=finder)
         center_col, center_row = bright['XCENTER'], bright['YCENTER']
     else:
         center_col, center_row = xcenter, ycenter
     
-    scale_to_physical, plate_scale_px, min_radius_real = compute_psf_scale(
-        dimension,
-        primary,
-        secondary,
-        f_number,
-        lambda_mean,
-        pixel_scale
-    )
-    
-    info("The radius of the first minimum in physical pixels is", min_radius_real, "px")
-    
-    scaled_psf, scaled_psf_ctr, max_aperture_radius = generate_scaled_psf(
-        dimension,
-        primary,
-        secondary,
-        scale_to_physical
-    )
-    
-    # wrap psf in a frame
-    psf = Frame(scaled_psf, scaled_psf_ctr)
-    
+    plate_scale_px = plate_scale(f_number, pixel_scale)
     if normalize_at != 0:
         max_extent_px = normalize_at
         debug("Rescaling to max integrated flux @ r=", max_extent_px, "pixels")
@@ -58,17 +40,31 @@ def photstrehlframe(image, primary, secondary, dimension, f_number, pixel_scale,
         max_extent_px = 2.5 / plate_scale_px # After 2.5" we're almost certainly measuring noise
         debug("after 2.5'' or", max_extent_px, "px we'll be almost certainly measuring noise")
     growth_max = max_extent_px + growth_step * 3 # do 3 steps beyond the 2.5" mark
-    assert growth_max < max_aperture_radius, "Curve of Growth won't fit on PSF frame with this max extent"
     
-    # phot CoG needs a FITS file, so write one:
-    psftmpfilename = os.path.abspath('./{0}.fits'.format(uuid.uuid1()))
-    hdu = pyfits.PrimaryHDU(psf.data)
-    hdu.writeto(psftmpfilename)
-    debug("psf FITS file temporarily stored in", psftmpfilename)
+    # ideal psf, with CoG and profile precomputed to be rescaled later
+    psf, scale_to_physical, plate_scale_px, min_radius_real, max_aperture_radius = ideal_psf(
+        dimension,
+        primary,
+        secondary,
+        f_number,
+        pixel_scale,
+        lambda_mean,
+        growth_step,
+        method='exact',
+        max_aperture=growth_max,
+        engine=psfengine,
+        oversample=oversample,
+        spiders=spiders,
+        spider_width=spider_width,
+        pupilfile=pupilfile,
+        fft_threads=fftthreads,
+        single=fftsingle,
+        quiet=quiet,
+        use_cache=psfcache
+    )
     
-    # precompute CoG and profile to be rescaled later
-    phot_curve_of_growth(psf, psftmpfilename, growth_max, step=growth_step, quiet=quiet, fitsky=False)
-    profile_from_growthcurve(psf)
+    info("The radius of the first minimum in physical pixels is", min_radius_real, "px")
+    assert growth_max < max_aperture_radius, "Curve of Growth won't fit on PSF frame with this max extent"
     
     # values and functions to rescale our PSF Frame computed values
     # to physical counts
@@ -88,13 +84,14 @@ def photstrehlframe(image, primary, secondary, dimension, f_number, pixel_scale,
         return psf.profile * scale_factor, psf.fluxes * scale_factor
 
     image_base = os.path.splitext(os.path.basename(image))[0]
-    frame = Frame(pyfits.getdata(image), (float(center_col), float(center_row)))
+    # center is in 1-indexed IRAF coordinates, as phot used it
+    frame = Frame(pyfits.getdata(image), (float(center_col) - 1.0, float(center_row) - 1.0))
     debug("loaded frame from", image)
     # subtract median row to handle light/charge leakage biasing measurements
     exclude_from, exclude_to = frame.ybounds(r=int(max_extent_px)) # exclude region of max_extent_px around center of frame
     avgrow_median_subtract(frame, exclude_from, exclude_to)
     debug("median subtracted frame")
-    phot_curve_of_growth(frame, image, growth_max, step=growth_step, quiet=quiet, fitsky=True)
+    exact_curve_of_growth(frame, growth_max, step=growth_step, quiet=quiet, fitsky=True)
     debug("curve of growth generated")
     profile_from_growthcurve(frame)
     debug("profile generated")
@@ -1,57 +1,57 @@
-from PIL import Image
 import numpy
-import re
-import glob
 import os.path
+from multiprocessing.pool import ThreadPool
 from pyraf import iraf
 import pyfits
-from aotools.util import debug, info, warn, error
+from aotools.util import debug, info, warn, error, read_png, find_numbered_files, FitsMemmapWriter
 
-def pngtocube(directory, filepattern, outfile, exposure):
+def pngtocube(directory, filepattern, outfile, exposure, threads=4):
     if os.path.exists(outfile):
         error("File", outfile, "already exists!")
         return
-    files = glob.glob(os.path.join(directory, "*"))
-    
-    # turn filepattern into a regex
-    filepattern = filepattern.replace('$i', r'(\d+)')
-    
-    # sort files by index instead of lexically
-    # (i.e. [99.png, 100.png, 990.png] not [100.png, 99.png, 990.png])
-    filetuples = []
-    for f in files:
-        _, fname = os.path.split(f)
-        match = re.match(filepattern, fname)
-        if match:
-            index = int(match.groups()[0])
-            filetuples.append((index, fname))
-
-    filetuples.sort()
-    
-    
-    # from pprint import pprint
-    # pprint(filetuples)
+    filetuples = find_numbered_files(directory, filepattern)
+    if not filetuples:
+        error("No files in", directory, "match", filepattern)
+        return
     debug("Have", len(filetuples), "frames, numbered", filetuples[0][0], "to", filetuples[-1][0])
-    
-    # get image dimensions from first input file
+
+    # get image dimensions and type from first input file
     # (assuming all frames are the same shape, which should be true)
-    img = Image.open(filetuples[0][1])
-    data = numpy.array(img)
-    debug("Input frame shape:", data.shape)
-    
-    shape = (len(filetuples), data.shape[0], data.shape[1])
-    cubedata = numpy.zeros(shape)
+    first = read_png(filetuples[0][1])
+    debug("Input frame shape:", first.shape, "type:", first.dtype)
+    shape = (len(filetuples),) + first.shape
     debug("Output cube shape:", shape)
-    
-    for idx, infile in filetuples:
-        img = Image.open(infile)
-        data = numpy.array(img)
-        cubedata[idx] = data
-    
-    hdu = pyfits.PrimaryHDU(cubedata)
-    hdu.header['EXPOSURE'] = exposure
-    hdulist = pyfits.HDUList([hdu])
-    hdu.writeto(outfile)
+
+    header = pyfits.Header()
+    header['EXPOSURE'] = exposure
+    writer = FitsMemmapWriter(outfile, shape, first.dtype, template=header)
+
+    def convert(args):
+        # frames go in the cube in index order, whatever their numbering
+        position, (index, infile) = args
+        data = read_png(infile)
+        if data.shape != first.shape or data.dtype != first.dtype:
+            raise ValueError("{0} is {1} {2}, not {3} {4} like the first frame".format(
+                infile, data.shape, data.dtype, first.shape, first.dtype))
+        writer[position] = data
+        return position
+
+    # decoding releases the GIL, so a thread pool keeps the disk busy;
+    # each frame is written straight into the mapped file as it's done
+    pool = ThreadPool(threads)
+    try:
+        for done, position in enumerate(pool.imap_unordered(convert, enumerate(filetuples), chunksize=16)):
+            if (done + 1) % 1000 == 0:
+                debug("converted", done + 1, "of", len(filetuples), "frames")
+        pool.close()
+    except:
+        pool.terminate()
+        writer.close()
+        os.remove(outfile)
+        raise
+    finally:
+        pool.join()
+    writer.close()
     info("Wrote to", outfile)
 
 parfile = iraf.osfn("aotools$pngtocube.par")
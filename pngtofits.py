@@ -1,27 +1,203 @@
 import glob
-from PIL import Image
+import re
+import time
 import numpy
+import os
 import os.path
+from multiprocessing.pool import ThreadPool
 from pyraf import iraf
 import pyfits
-from aotools.util import debug, info, warn, error
+from aotools.util import debug, info, warn, error, read_png, image_header, fits_storage
 
-def pngtofits(infile, exposure):
+def _natural_key(path):
+    # sort frame_9.png before frame_10.png
+    return [int(part) if part.isdigit() else part for part in re.split(r'(\d+)', path)]
+
+def _fits_name(pngfile):
+    base, ext = os.path.splitext(pngfile)
+    return '{0}.fits'.format(base)
+
+def _up_to_date(pngfile, fitsfile):
+    """Whether `fitsfile` is a complete conversion of `pngfile` at least as new as it"""
+    if not os.path.exists(fitsfile):
+        return False
+    # FITS files are whole 2880 byte blocks
+    size = os.path.getsize(fitsfile)
+    return size > 0 and size % 2880 == 0 and os.path.getmtime(fitsfile) >= os.path.getmtime(pngfile)
+
+def _convert(pngfile, exposure):
+    fitsfile = _fits_name(pngfile)
+    data = read_png(pngfile)
+    stored, bzero = fits_storage(data.dtype)
+    header = image_header(data.shape, stored)
+    if bzero:
+        header['BSCALE'] = 1
+        header['BZERO'] = bzero
+    header['EXPOSURE'] = exposure
+    # write under a temporary name, so an interrupted run never leaves
+    # a partial file that looks finished
+    partial = fitsfile + '.part'
+    with open(partial, 'wb') as f:
+        _write_hdu(f, header, data, bzero)
+    os.rename(partial, fitsfile)
+    return fitsfile
+
+def _write_hdu(f, header, data, bzero):
+    f.write(header.tostring().encode('ascii'))
+    stored = numpy.dtype(fits_storage(data.dtype)[0]).newbyteorder('>')
+    if bzero:
+        data = numpy.asarray(data, dtype=numpy.int64) - bzero
+    numpy.asarray(data, dtype=stored).tofile(f)
+    # pad the data to a whole FITS block
+    f.write(b'\0' * (-data.size * stored.itemsize % 2880))
+
+def _extension_names(mefile):
+    hdulist = pyfits.open(mefile)
+    try:
+        return set(hdu.name.upper() for hdu in hdulist[1:])
+    finally:
+        hdulist.close()
+
+def _card_int(card):
+    return int(card[10:].split(b'/')[0].strip())
+
+def _complete_length(mefile):
+    """
+    Bytes at the start of `mefile` taken up by completely written HDUs,
+    which is less than its size if a run was killed partway through
+    appending an extension
+    """
+    size = os.path.getsize(mefile)
+    complete = 0
+    with open(mefile, 'rb') as f:
+        while complete < size:
+            f.seek(complete)
+            values, axes, header_bytes, ended = {}, {}, 0, False
+            while not ended:
+                block = f.read(2880)
+                if len(block) < 2880:
+                    return complete
+                header_bytes += 2880
+                for start in range(0, 2880, 80):
+                    card = block[start:start + 80]
+                    keyword = card[:8].strip()
+                    if keyword == b'END':
+                        ended = True
+                        break
+                    if keyword in (b'BITPIX', b'NAXIS', b'PCOUNT', b'GCOUNT'):
+                        values[keyword] = _card_int(card)
+                    elif keyword.startswith(b'NAXIS'):
+                        axes[keyword] = _card_int(card)
+            naxis = values.get(b'NAXIS', 0)
+            pixels = 1
+            for axis in range(1, naxis + 1):
+                pixels *= axes[b'NAXIS' + str(axis).encode('ascii')]
+            data_bytes = 0
+            if naxis > 0:
+                data_bytes = (abs(values[b'BITPIX']) // 8 * values.get(b'GCOUNT', 1)
+                              * (values.get(b'PCOUNT', 0) + pixels))
+            # data are padded to whole 2880 byte blocks
+            end = complete + header_bytes + data_bytes + (-data_bytes % 2880)
+            if end > size:
+                return complete
+            complete = end
+    return complete
+
+def _repair_mefile(mefile):
+    """
+    Cut off a partly written extension left at the end of `mefile` by a
+    killed run, so it ends on its last complete HDU
+    """
+    size = os.path.getsize(mefile)
+    complete = _complete_length(mefile)
+    if complete == size:
+        return
+    if complete == 0:
+        warn("No complete primary HDU in", mefile, "- starting it over")
+        os.remove(mefile)
+        return
+    warn("Dropping", size - complete, "bytes of a partly written extension from the end of", mefile)
+    with open(mefile, 'r+b') as f:
+        f.truncate(complete)
+
+def _append_extensions(mefile, files, exposure, pool, batch_size):
+    """Append each PNG in `files` to `mefile` as an IMAGE extension named for it, in order"""
+    if not os.path.exists(mefile):
+        with open(mefile, 'wb') as f:
+            header = image_header((), numpy.uint8)
+            header['EXTEND'] = True
+            f.write(header.tostring().encode('ascii'))
+    with open(mefile, 'ab') as f:
+        complete = f.tell()
+        try:
+            for start in range(0, len(files), batch_size):
+                batch = files[start:start + batch_size]
+                # decode a batch in parallel, append in order
+                for pngfile, data in zip(batch, pool.imap(read_png, batch)):
+                    stored, bzero = fits_storage(data.dtype)
+                    header = image_header(data.shape, stored, extension=True)
+                    if bzero:
+                        header['BSCALE'] = 1
+                        header['BZERO'] = bzero
+                    header['EXTNAME'] = os.path.basename(pngfile)
+                    header['EXPOSURE'] = exposure
+                    _write_hdu(f, header, data, bzero)
+                    complete = f.tell()
+                debug("appended", start + len(batch), "of", len(files), "frames to", mefile)
+        except:
+            # drop a partly written extension
+            f.truncate(complete)
+            raise
+
+def pngtofits(infile, exposure, threads=4, update=True, mefile=''):
     # Is this a wildcard pattern?
     if '*' in infile:
-        files = glob.glob(infile) # list of all matching
-        debug("converting all of", files)
+        files = sorted(glob.glob(infile), key=_natural_key) # list of all matching
+        debug("found", len(files), "files matching", infile)
     else:
         files = [infile,] # list of one
-    
-    for fn in files:
-        base, ext = os.path.splitext(fn)
-        img = Image.open(fn)
-        data = numpy.array(img)
-        hdu = pyfits.PrimaryHDU(data)
-        hdu.header['EXPOSURE'] = exposure
-        hdu.writeto('{0}.fits'.format(base))
-        info("Wrote to",'{0}.fits'.format(base))
+
+    # temporary files from interrupted conversions
+    for partial in glob.glob(_fits_name(infile) + '.part'):
+        debug("removing partly converted", partial)
+        os.remove(partial)
+
+    if mefile:
+        if os.path.exists(mefile):
+            _repair_mefile(mefile)
+        done = _extension_names(mefile) if os.path.exists(mefile) else set()
+        # extension names are case-insensitive
+        todo = [fn for fn in files if os.path.basename(fn).upper() not in done]
+    elif update:
+        todo = [fn for fn in files if not _up_to_date(fn, _fits_name(fn))]
+    else:
+        todo = files
+    if len(todo) < len(files):
+        info("Skipping", len(files) - len(todo), "files already converted")
+    if not todo:
+        return
+
+    start_time = time.time()
+    pool = ThreadPool(threads)
+    try:
+        if mefile:
+            _append_extensions(mefile, todo, exposure, pool, batch_size=threads * 16)
+        else:
+            for count, fitsfile in enumerate(pool.imap_unordered(lambda fn: _convert(fn, exposure), todo, chunksize=16)):
+                debug("Wrote to", fitsfile)
+                if (count + 1) % 1000 == 0:
+                    info("converted", count + 1, "of", len(todo), "frames")
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    elapsed = time.time() - start_time
+    info("Converted", len(todo), "frames in", round(elapsed, 2), "s",
+        "({0:.1f} frames/s)".format(len(todo) / max(elapsed, 1e-6)))
+    if mefile:
+        info("Wrote to", mefile)
 
 parfile = iraf.osfn("aotools$pngtofits.par")
 t = iraf.IrafTaskFactory(taskname="pngtofits", value=parfile, function=pngtofits)
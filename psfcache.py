@@ -0,0 +1,220 @@
+import os
+import errno
+import hashlib
+import tempfile
+import numpy as np
+# why won't logging work in PyRAF :(
+from aotools.util import debug, info, warn, error, ensure_dir
+from aotools.strehl import (Frame, compute_psf_scale, generate_scaled_psf,
+    curve_of_growth, exact_curve_of_growth, profile_from_growthcurve, mft_pupil,
+    FFTBackend
+)
+
+# bump when a change to the PSF or curve of growth code invalidates old entries
+CACHE_VERSION = 1
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.aotools', 'psfcache')
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+class PSFCache(object):
+    """
+    Content-addressed on-disk cache of ideal PSFs and their curves of
+    growth. Entries are .npz files named for a hash of the parameters
+    that produced them; the least recently used entries are evicted
+    once the cache grows past `max_bytes`.
+    
+    cache_dir - where to keep entries (default: $AOTOOLS_PSF_CACHE,
+                or ~/.aotools/psfcache)
+    max_bytes - size cap for the whole cache (default: 256 MB)
+    """
+    def __init__(self, cache_dir=None, max_bytes=DEFAULT_MAX_BYTES):
+        if cache_dir is None:
+            cache_dir = os.environ.get('AOTOOLS_PSF_CACHE', DEFAULT_CACHE_DIR)
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        ensure_dir(self.cache_dir)
+    
+    def key(self, params):
+        """Hash a dict of parameters into a cache key"""
+        items = sorted(params.items()) + [('version', CACHE_VERSION)]
+        return hashlib.sha1(repr(items)).hexdigest()
+    
+    def path(self, key):
+        return os.path.join(self.cache_dir, '{0}.npz'.format(key))
+    
+    def get(self, params):
+        """Return a dict of cached arrays for `params`, or None on a miss"""
+        path = self.path(self.key(params))
+        try:
+            with open(path, 'rb') as f:
+                npz = np.load(f)
+                entry = dict((name, npz[name]) for name in npz.files)
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                warn("Could not read PSF cache entry", path, e)
+            return None
+        except (ValueError, KeyError), e:
+            warn("Discarding corrupt PSF cache entry", path, e)
+            self._remove(path)
+            return None
+        os.utime(path, None) # mark as recently used
+        debug("PSF cache hit", path)
+        return entry
+    
+    def put(self, params, entry):
+        """Store a dict of arrays for `params`, then evict down to size"""
+        path = self.path(self.key(params))
+        # write to a temporary name and rename, so a crash never leaves
+        # a half-written entry behind
+        fd, tmppath = tempfile.mkstemp(suffix='.tmp', dir=self.cache_dir)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, **entry)
+            os.rename(tmppath, path)
+        except Exception:
+            self._remove(tmppath)
+            raise
+        debug("PSF cache stored", path)
+        self.evict(keep=path)
+    
+    def evict(self, keep=None):
+        """Remove least recently used entries until under max_bytes"""
+        entries = []
+        for fn in os.listdir(self.cache_dir):
+            if not fn.endswith('.npz'):
+                continue
+            path = os.path.join(self.cache_dir, fn)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        for mtime, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            debug("PSF cache evicting", path)
+            self._remove(path)
+            total -= size
+    
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+def _compute_ideal_psf(dimension, primary, secondary, f_number, pixel_scale,
+        lambda_mean, growth_step, method, max_aperture, engine, oversample, pupil,
+        pupil_diameter, backend, quiet):
+    scale_to_physical, plate_scale_px, min_radius_real = compute_psf_scale(
+        dimension,
+        primary,
+        secondary,
+        f_number,
+        lambda_mean,
+        pixel_scale,
+        engine=engine,
+        backend=backend
+    )
+    
+    scaled_psf, scaled_psf_ctr, max_aperture_radius = generate_scaled_psf(
+        dimension,
+        primary,
+        secondary,
+        scale_to_physical,
+        engine=engine,
+        oversample=oversample,
+        pupil=pupil,
+        pupil_diameter=pupil_diameter,
+        backend=backend
+    )
+    
+    # wrap psf in a frame
+    psf = Frame(scaled_psf, scaled_psf_ctr)
+    if max_aperture is None:
+        max_aperture = max_aperture_radius
+    if method == 'exact':
+        exact_curve_of_growth(psf, max_aperture, step=growth_step, quiet=quiet, fitsky=False)
+    else:
+        curve_of_growth(psf, max_aperture, step=growth_step, quiet=quiet)
+    profile_from_growthcurve(psf)
+    
+    return {
+        'data': psf.data,
+        'center': np.array(psf.center, dtype=np.float64),
+        'scale_to_physical': np.float64(scale_to_physical),
+        'plate_scale_px': np.float64(plate_scale_px),
+        'min_radius_real': np.float64(min_radius_real),
+        'max_aperture_radius': np.float64(max_aperture_radius),
+        'radii': psf.radii,
+        'fluxes': psf.fluxes,
+        'npix': psf.npix,
+        'profile': psf.profile,
+        'profile_npix': psf.profile_npix,
+    }
+
+def ideal_psf(dimension, primary, secondary, f_number, pixel_scale, lambda_mean,
+        growth_step, method='binned', max_aperture=None, engine='fft', oversample=1,
+        spiders=0, spider_width=0.0, pupilfile=None, fft_threads=1, single=False,
+        quiet=True, use_cache=True):
+    """
+    Generate the scaled ideal PSF along with its curve of growth and
+    profile, reusing a cached copy when the same optics and photometry
+    parameters have been seen before.
+    
+    method - 'binned' for curve_of_growth or 'exact' for
+             exact_curve_of_growth (default: 'binned')
+    max_aperture - radius to grow the PSF curve of growth to
+                   (default: None, meaning the whole scaled PSF)
+    engine - 'fft' or 'airy', see generate_scaled_psf (default: 'fft')
+    oversample - pixel integration for the 'airy' and 'mft' engines
+                 (default: 1)
+    spiders, spider_width, pupilfile - pupil for the 'mft' engine,
+                                       see mft_pupil
+    fft_threads - worker threads for the 'fft' engine (default: 1)
+    single - compute the 'fft' engine in single precision (default: False)
+    use_cache - look up and store results in the PSF cache (default: True)
+    
+    Returns (psf, scale_to_physical, plate_scale_px, min_radius_real,
+    max_aperture_radius), where psf is a Frame with the radii, fluxes,
+    npix, profile and profile_npix attributes filled in.
+    """
+    params = {
+        'dimension': int(dimension),
+        'primary': float(primary),
+        'secondary': float(secondary),
+        'f_number': float(f_number),
+        'pixel_scale': float(pixel_scale),
+        'lambda_mean': float(lambda_mean),
+        'growth_step': float(growth_step),
+        'method': method,
+        'max_aperture': None if max_aperture is None else float(max_aperture),
+        'engine': engine,
+        'oversample': int(oversample),
+        'single': bool(single),
+    }
+    pupil, pupil_diameter = None, None
+    if engine == 'mft':
+        pupil, pupil_diameter = mft_pupil(primary, secondary, spiders, spider_width, pupilfile)
+        # key on the pupil itself, so edits to a pupil file are noticed
+        params['pupil'] = hashlib.sha1(np.ascontiguousarray(pupil).tostring()).hexdigest()
+        params['pupil_shape'] = pupil.shape
+        params['pupil_diameter'] = float(pupil_diameter)
+    cache = PSFCache() if use_cache else None
+    entry = cache.get(params) if cache is not None else None
+    if entry is None:
+        entry = _compute_ideal_psf(dimension, primary, secondary, f_number,
+            pixel_scale, lambda_mean, growth_step, method, max_aperture, engine,
+            oversample, pupil, pupil_diameter, FFTBackend(fft_threads, single), quiet)
+        if cache is not None:
+            cache.put(params, entry)
+    else:
+        info("Using cached ideal PSF from", cache.cache_dir)
+    
+    psf = Frame(entry['data'], tuple(entry['center']))
+    psf.radii, psf.fluxes, psf.npix = entry['radii'], entry['fluxes'], entry['npix']
+    psf.profile, psf.profile_npix = entry['profile'], entry['profile_npix']
+    return (psf, float(entry['scale_to_physical']), float(entry['plate_scale_px']),
+        float(entry['min_radius_real']), float(entry['max_aperture_radius']))
@@ -11,25 +11,20 @@ import matplotlib
 matplotlib.use('agg') # cannot import pyplot within pyraf without this
 from matplotlib import pyplot as plt
 # why won't logging work in PyRAF :(
-from aotools.util import debug, info, warn, error, write_table, parse_ranges
-from aotools.strehl import Frame, avgrow, avgrow_median_subtract
+from aotools.util import debug, info, warn, error, write_table, parse_ranges, stream_cube
+from aotools.strehl import Frame, avgrow, avgrow_median_subtract, avgrow_median_subtract_cube
 
-def removeband(infile, outfile, exclude_from, exclude_to):
-    imagehdul = pyfits.open(infile)
-    data = imagehdul[0].data
-    if len(data.shape) == 3:
-        debug("Operating on a data cube")
-        for idx in range(0, data.shape[0]):
-            debug("Processing frame", idx + 1, "of", data.shape[0])
-            frame = Frame(data[idx], None)
-            avgrow_median_subtract(frame, exclude_from, exclude_to)
-            data[idx] = frame.data
-        imagehdul[0].data = data
-    else:
-        frame = Frame(data, None)
-        avgrow_median_subtract(frame, exclude_from, exclude_to)
-        imagehdul[0].data = frame.data
-    imagehdul.writeto(outfile)
+def removeband(infile, outfile, exclude_from, exclude_to, chunk_mb=64, outtype='float32'):
+    buffers = {}
+    def deband(chunk, start):
+        debug("Processing frames", start + 1, "to", start + chunk.shape[0])
+        # the writer is done with the last chunk by now, so reuse its buffer
+        if chunk.shape not in buffers:
+            buffers.clear()
+            buffers[chunk.shape] = np.empty(chunk.shape, dtype=outtype)
+        return avgrow_median_subtract_cube(chunk, exclude_from, exclude_to, out=buffers[chunk.shape])
+    
+    stream_cube(infile, outfile, deband, chunk_mb=chunk_mb)
     info("Wrote corrected (de-banded and median subtracted) image to", outfile)
     
 parfile = iraf.osfn("aotools$removeband.par")
@@ -0,0 +1,313 @@
+import os
+import struct
+import shutil
+import hashlib
+import numpy as np
+# why won't logging work in PyRAF :(
+from aotools.util import (debug, info, warn, error, ensure_dir, file_checksum,
+    map_cube_frames, imap_cube_frames, exclude_frames
+)
+
+# a Strehl series is a directory of .npy files, one per column, each with
+# one row per frame (except radii, written once)
+SERIES_COLUMNS = (
+    ('frame', np.int64, ()),
+    ('center', np.float64, (2,)),
+    ('track', np.int8, ()),
+    ('strehl', np.float64, None), # None: one value per radius
+    ('flux', np.float64, None),
+)
+# fixed-size .npy header, so it can be rewritten in place as rows are added
+NPY_HEADER_BYTES = 128
+
+def _npy_header(dtype, shape):
+    descr = np.lib.format.dtype_to_descr(np.dtype(dtype))
+    fields = "{{'descr': {0!r}, 'fortran_order': False, 'shape': {1!r}, }}".format(descr, tuple(shape))
+    magic = np.lib.format.magic(1, 0)
+    padding = NPY_HEADER_BYTES - len(magic) - 2 - len(fields) - 1
+    if padding < 0:
+        raise ValueError("Shape {0} doesn't fit in a {1} byte .npy header".format(shape, NPY_HEADER_BYTES))
+    return magic + struct.pack('<H', len(fields) + padding + 1) + fields.encode('latin1') + b' ' * padding + b'\n'
+
+def _load(path, mmap_mode):
+    with open(path, 'rb') as f:
+        np.lib.format.read_magic(f)
+        shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+    if shape[0] == 0:
+        # nothing to memory-map in a column with no rows yet
+        return np.zeros(shape, dtype=dtype)
+    return np.load(path, mmap_mode=mmap_mode)
+
+class _AppendableArray(object):
+    """
+    A .npy file that grows along its first axis. Rows are written at
+    the end of the file, then the header is updated with the new
+    length, so a reader never sees rows that aren't completely written.
+    """
+    def __init__(self, path, dtype, row_shape, append=False):
+        self.path = path
+        self.dtype = np.dtype(dtype).newbyteorder('<')
+        self.row_shape = tuple(row_shape)
+        if append and os.path.exists(path):
+            existing = _load(path, 'r')
+            if existing.shape[1:] != self.row_shape or existing.dtype != self.dtype:
+                raise ValueError("Can't append {0} rows of {1} to {2} with rows {3} of {4}".format(
+                    self.row_shape, self.dtype, path, existing.shape[1:], existing.dtype))
+            self.length = existing.shape[0]
+            del existing
+            self._file = open(path, 'r+b')
+            # drop anything after the last complete row (an interrupted append)
+            self._file.truncate(NPY_HEADER_BYTES + self.length * self._row_bytes())
+        else:
+            self.length = 0
+            self._file = open(path, 'w+b')
+            self._file.write(_npy_header(self.dtype, (0,) + self.row_shape))
+            self._file.flush()
+
+    def _row_bytes(self):
+        return self.dtype.itemsize * int(np.prod(self.row_shape))
+
+    def append(self, rows):
+        rows = np.ascontiguousarray(rows, dtype=self.dtype).reshape((-1,) + self.row_shape)
+        self._file.seek(0, os.SEEK_END)
+        rows.tofile(self._file)
+        self._file.flush()
+        self.length += rows.shape[0]
+        self._file.seek(0)
+        self._file.write(_npy_header(self.dtype, (self.length,) + self.row_shape))
+        self._file.flush()
+
+    def truncate(self, length):
+        """Drop every row after the first `length`"""
+        self.length = min(length, self.length)
+        self._file.truncate(NPY_HEADER_BYTES + self.length * self._row_bytes())
+        self._file.seek(0)
+        self._file.write(_npy_header(self.dtype, (self.length,) + self.row_shape))
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+def _open_columns(path, columns, radii, append=False):
+    """
+    Appendable arrays for each (name, dtype, row_shape) of `columns` in
+    the directory `path`, which also holds `radii`
+    """
+    radii = np.asarray(radii, dtype=np.float64)
+    ensure_dir(path)
+    radii_path = os.path.join(path, 'radii.npy')
+    if append and os.path.exists(radii_path):
+        if not np.array_equal(np.load(radii_path), radii):
+            raise ValueError("Radii don't match those of the series in {0}".format(path))
+    else:
+        np.save(radii_path, radii)
+    arrays = {}
+    for name, dtype, row_shape in columns:
+        if row_shape is None:
+            row_shape = radii.shape
+        arrays[name] = _AppendableArray(os.path.join(path, name + '.npy'), dtype, row_shape, append=append)
+    # if appending a batch was interrupted, some columns may have more rows
+    length = min(array.length for array in arrays.values())
+    for array in arrays.values():
+        if array.length > length:
+            array.truncate(length)
+    return arrays
+
+def _read_columns(path, columns, mmap_mode='r'):
+    series = {'radii': np.load(os.path.join(path, 'radii.npy'))}
+    for name, dtype, row_shape in columns:
+        series[name] = _load(os.path.join(path, name + '.npy'), mmap_mode)
+    # a column may be a batch ahead if writing was interrupted
+    length = min(series[name].shape[0] for name, dtype, row_shape in columns)
+    for name, dtype, row_shape in columns:
+        series[name] = series[name][:length]
+    return series
+
+class StrehlSeriesWriter(object):
+    """
+    Writes a Strehl time series in binary, column by column, a batch of
+    frames at a time. Read it back with read_strehl_series.
+
+    path - directory to hold the series (created if needed)
+    radii - radii (in px) at which Strehl ratios and fluxes are measured
+    append - add to an existing series at `path` instead of starting
+             over (default: False)
+    """
+    def __init__(self, path, radii, append=False):
+        self.path = path
+        self.columns = _open_columns(path, SERIES_COLUMNS, radii, append=append)
+
+    def append(self, frames, centers, tracks, strehls, fluxes):
+        """Add a batch of frames (one row per frame in each argument)"""
+        values = {'frame': frames, 'center': centers, 'track': tracks, 'strehl': strehls, 'flux': fluxes}
+        for name, dtype, row_shape in SERIES_COLUMNS:
+            self.columns[name].append(values[name])
+
+    def close(self):
+        for column in self.columns.values():
+            column.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def read_strehl_series(path, mmap_mode='r'):
+    """
+    Read a binary Strehl series written by StrehlSeriesWriter as a dict
+    of arrays named for its columns (frame, center, track, strehl, flux
+    and radii), memory-mapped unless `mmap_mode` is None
+    """
+    return _read_columns(path, SERIES_COLUMNS, mmap_mode=mmap_mode)
+
+# per-frame results a Strehl task needs to finish an interrupted run
+CHECKPOINT_COLUMNS = (
+    ('frame', np.int64, ()),
+    ('center', np.float64, (2,)),
+    ('track', np.int8, ()),
+    ('flux', np.float64, None),
+    ('npix', np.float64, None),
+)
+
+def checkpoint_key(cubefile, params):
+    """
+    Key identifying an analysis run: the cube's path, modification time
+    and checksum, and a dict of the parameters that affect per-frame
+    results. The checksum only samples the cube (see
+    util.file_checksum), so the modification time is what catches a cube
+    rewritten with new pixels only in blocks it didn't sample.
+    """
+    items = [('cubefile', os.path.abspath(cubefile)), ('mtime', os.path.getmtime(cubefile)),
+             ('checksum', file_checksum(cubefile))]
+    items += sorted(params.items())
+    return hashlib.sha1(repr(items)).hexdigest()
+
+class Checkpoint(object):
+    """
+    Per-frame results of a Strehl task saved batch by batch in the
+    directory `path`, so a restarted run can skip the frames already
+    done. A checkpoint left by a run with a different `key` (another
+    cube, a changed cube or different parameters) is discarded.
+    
+    path - directory for the checkpoint (created if needed)
+    key - from checkpoint_key
+    radii - radii of the curves of growth being saved
+    """
+    def __init__(self, path, key, radii):
+        self.path = path
+        key_path = os.path.join(path, 'key')
+        resume = False
+        if os.path.exists(key_path):
+            with open(key_path) as f:
+                resume = f.read().strip() == key
+            if not resume:
+                warn("Checkpoint in", path, "is from a different cube or parameters; starting over")
+                shutil.rmtree(path)
+        try:
+            self.columns = _open_columns(path, CHECKPOINT_COLUMNS, radii, append=resume)
+        except ValueError, e:
+            warn("Discarding unusable checkpoint in", path, e)
+            shutil.rmtree(path)
+            self.columns = _open_columns(path, CHECKPOINT_COLUMNS, radii)
+        with open(key_path, 'w') as f:
+            f.write(key + '\n')
+        if resume:
+            info("Resuming from checkpoint in", path, "with", self.columns['frame'].length, "frames done")
+
+    def done_frames(self):
+        """Frame numbers already saved"""
+        return set(int(i) for i in self.read()['frame'])
+
+    def append(self, frames, centers, tracks, fluxes, npix):
+        """Save a batch of frames (one row per frame in each argument)"""
+        values = {'frame': frames, 'center': centers, 'track': tracks, 'flux': fluxes, 'npix': npix}
+        for name, dtype, row_shape in CHECKPOINT_COLUMNS:
+            self.columns[name].append(values[name])
+
+    def read(self, mmap_mode='r'):
+        """Saved results as a dict of arrays named for the columns"""
+        return _read_columns(self.path, CHECKPOINT_COLUMNS, mmap_mode=mmap_mode)
+
+    def close(self):
+        for column in self.columns.values():
+            column.close()
+
+    def remove(self):
+        """Close and delete the checkpoint (once the run is complete)"""
+        self.close()
+        shutil.rmtree(self.path)
+
+def _rows_to_columns(rows):
+    return (
+        np.array([row[0] for row in rows]),
+        np.array([row[1] for row in rows]).reshape(-1, 2),
+        np.array([row[2] for row in rows]),
+        np.array([row[3] for row in rows]),
+        np.array([row[4] for row in rows]),
+    )
+
+def analyze_frames(cubefile, range_pairs, make_worker, radii, workers=1,
+        checkpoint_path=None, key=None, batch_frames=100, chunk_frames=None, stacked=False):
+    """
+    Run a Strehl task's per-frame analysis (see imap_cube_frames) over
+    the frames in `range_pairs`, where each frame's result is a tuple
+    (frame number, (xcenter, ycenter), track flag, fluxes, npix).
+    `chunk_frames` and `stacked` are passed on to imap_cube_frames.
+    
+    With a `checkpoint_path`, results are saved to a Checkpoint (with
+    `key`, from checkpoint_key) every `batch_frames` frames, and frames
+    it already holds are not analyzed again.
+    
+    Returns arrays (frames, centers, tracks, fluxes, npix) with one row
+    per frame of `range_pairs`, in order.
+    """
+    if checkpoint_path is None:
+        return _rows_to_columns(map_cube_frames(cubefile, range_pairs, make_worker, workers=workers,
+            chunk_frames=chunk_frames, stacked=stacked))
+    if chunk_frames:
+        batch_frames = min(batch_frames, chunk_frames)
+    checkpoint = Checkpoint(checkpoint_path, key, radii)
+    try:
+        todo = exclude_frames(range_pairs, checkpoint.done_frames())
+        for rows in imap_cube_frames(cubefile, todo, make_worker, workers=workers, chunk_frames=batch_frames,
+                stacked=stacked):
+            checkpoint.append(*_rows_to_columns(rows))
+            debug("checkpointed frames", rows[0][0], "to", rows[-1][0])
+        saved = checkpoint.read(mmap_mode=None)
+    finally:
+        checkpoint.close()
+    index = dict((int(frame_num), idx) for idx, frame_num in enumerate(saved['frame']))
+    order = np.array([index[i] for fromidx, toidx in range_pairs for i in range(fromidx, toidx + 1)], dtype=int)
+    return tuple(saved[name][order] for name in ('frame', 'center', 'track', 'flux', 'npix'))
+
+def discard_checkpoint(path):
+    """Remove the checkpoint in `path` (once its run is complete), if any"""
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+        debug("removed checkpoint", path)
+
+def write_strehl_series_text(outfile, frames, centers, tracks, radii, strehls):
+    """
+    Write a Strehl series as tab-separated text: frame index, center,
+    track flag and then the Strehl ratio at each radius, one frame per line
+    """
+    frames = np.asarray(frames)
+    table = np.column_stack((frames, centers, tracks, strehls)) if len(frames) else np.zeros((0, 4 + len(radii)))
+    fmt = ['%d', '%.12g', '%.12g', '%d'] + ['%.12g'] * len(radii)
+    with open(outfile, 'w') as f:
+        f.write("# columns 5 and up are the pixel radii at which we computed the Strehl ratio\n")
+        f.write("# track: -1 = fixed center, 0 = full frame search, 1 = tracked, 2 = lost and found again by full frame search, "
+                "3 = center from a center table or batch centroiding\n")
+        f.write("# frameidx\txcenter\tycenter\ttrack\t")
+        f.write('\t'.join(map(str, radii)))
+        f.write('\n')
+        np.savetxt(f, table, fmt=fmt, delimiter='\t')
+    debug("Wrote", len(frames), "frames of Strehl series to", outfile)
+
+def export_strehl_series_text(path, outfile):
+    """Export the binary Strehl series in `path` to the text format"""
+    series = read_strehl_series(path)
+    write_strehl_series_text(outfile, series['frame'], series['center'], series['track'],
+                             series['radii'], series['strehl'])
+    return outfile
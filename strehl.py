@@ -6,11 +6,23 @@ import numpy as np
 import tempfile
 import shutil
 import scipy.ndimage
+import scipy.special
 import matplotlib
 matplotlib.use('agg') # cannot import pyplot within pyraf without this
 from matplotlib import pyplot as plt
 # why won't logging work in PyRAF :(
-from aotools.util import debug, info, warn, error, parse_coo_file
+from aotools.util import debug, info, warn, error, parse_coo_file, COO_DTYPE
+
+# optional faster FFT libraries, in order of preference
+try:
+    import pyfftw
+    import pyfftw.builders
+except ImportError:
+    pyfftw = None
+try:
+    import scipy.fft as scipy_fft
+except ImportError:
+    scipy_fft = None
 
 def generate_pupil(dim, aperture_radius, obscuration_radius=0):
     """
@@ -22,9 +34,53 @@ def generate_pupil(dim, aperture_radius, obscuration_radius=0):
     """
     pupil = np.zeros((dim, dim))
     center = int(round(dim / 2)), int(round(dim / 2))
-    pupil[generate_circular_mask(dim, center, aperture_radius, obscuration_radius)] = 1
+    region, submask = circular_mask_region(dim, center, aperture_radius, obscuration_radius)
+    pupil[region][submask] = 1
     return pupil
 
+def add_spider_vanes(pupil, n_vanes, width, angle=0.0):
+    """
+    Zero out secondary support vanes running from the center of a pupil
+    (as generated by generate_pupil) to its edge. Modifies `pupil` in
+    place and returns it.
+    
+    n_vanes - number of evenly spaced vanes
+    width - vane width (same units as the pupil radius)
+    angle - angle of the first vane in degrees from the +x axis (default: 0)
+    """
+    rows, cols = pupil.shape
+    y = (np.arange(rows) - int(round(rows / 2)))[:,np.newaxis]
+    x = (np.arange(cols) - int(round(cols / 2)))[np.newaxis,:]
+    for n in range(n_vanes):
+        theta = math.radians(angle + n * 360.0 / n_vanes)
+        along = x * math.cos(theta) + y * math.sin(theta)
+        across = -x * math.sin(theta) + y * math.cos(theta)
+        pupil[(along >= 0) & (np.abs(across) <= width / 2.0)] = 0
+    return pupil
+
+def mft_pupil(primary, secondary, spiders=0, spider_width=0.0, pupilfile=None):
+    """
+    Pupil for the 'mft' PSF engine. Returns (pupil, pupil_diameter),
+    where pupil_diameter is the primary diameter in pupil samples.
+    
+    primary - outer radius of the annular pupil, in pupil samples
+    secondary - central obscuration radius, in pupil samples
+    spiders - number of support vanes to add (default: 0)
+    spider_width - vane width, in pupil samples (default: 0)
+    pupilfile - FITS image of the pupil to use instead of an annulus;
+                its full width is taken to be the primary diameter
+                (default: None)
+    """
+    if pupilfile:
+        pupil = pyfits.getdata(pupilfile).astype(np.float64)
+        debug("loaded", pupil.shape, "pupil from", pupilfile)
+        return pupil, float(pupil.shape[1])
+    dim = 2 * int(math.ceil(primary)) + 2
+    pupil = generate_pupil(dim, primary, secondary)
+    if spiders > 0:
+        add_spider_vanes(pupil, spiders, spider_width)
+    return pupil, 2.0 * primary
+
 # def generate_circular_mask(dim, center, outer_radius, inner_radius=0):
 #     """
 #     Generate a circular or annular boolean mask with optional central
@@ -120,42 +176,115 @@ def generate_pupil(dim, aperture_radius, obscuration_radius=0):
 #     )
 #     return mask
 
-def generate_circular_mask(dim, center, aperture_radius, obscuration_radius=0):
+def _round_away(i):
+    """Round i away from zero"""
+    return int(math.floor(i)) if i < 0.0 else int(math.ceil(i))
+
+def _image_shape(dim):
+    """Accept either a single dimension (square image) or a (rows, cols) tuple"""
+    try:
+        rows, cols = dim
+    except TypeError:
+        rows, cols = dim, dim
+    return int(rows), int(cols)
+
+def circular_mask_region(dim, center, aperture_radius, obscuration_radius=0):
     """
-    Generate a circular or annular boolean mask with optional central
-    obscuration. All dimensions in pixels.
+    Generate a circular or annular boolean mask covering only the bounding
+    box of the aperture. All dimensions in pixels.
     
-    dim - image dimensions
+    dim - image dimensions (int for a square image, or (rows, cols) tuple)
     center or (cx, cy) - center coordinates as tuple
-    outer_radius - outer radius
-    inner_radius - inner radius (default: 0)
+    aperture_radius - outer radius
+    obscuration_radius - inner radius (default: 0)
+    
+    Returns (region, submask), where region is a (row slice, col slice)
+    tuple such that `data[region][submask]` selects the aperture pixels.
+    The bounding box is clipped to the image, so apertures hanging off an
+    edge just lose the pixels outside the image.
     """
+    rows, cols = _image_shape(dim)
     inner_squared = obscuration_radius**2
     outer_squared = aperture_radius**2
     ccol, crow = center
-    mask = np.zeros((dim,dim), dtype="bool")
-    
-    def round_away(i):
-        """Round i away from zero"""
-        import math
-        return int(math.floor(i)) if i < 0.0 else int(math.ceil(i))
     
     # only touch elements in these ranges; ignore rest of array
-    row_from, row_to = round_away(crow - aperture_radius), round_away(crow + aperture_radius)
-    col_from, col_to = round_away(ccol - aperture_radius), round_away(ccol + aperture_radius)
-    
-    for a in range(row_from, row_to):
-        aidx2 = (a-crow)**2
-        for b in range(col_from, col_to):
-            r_squared = aidx2 + (b-ccol)**2
-            if r_squared > outer_squared:
-                mask[a][b] = False
-            else:
-                mask[a][b] = True if r_squared >= inner_squared else False
+    row_from = min(max(_round_away(crow - aperture_radius), 0), rows)
+    row_to = min(max(_round_away(crow + aperture_radius), 0), rows)
+    col_from = min(max(_round_away(ccol - aperture_radius), 0), cols)
+    col_to = min(max(_round_away(ccol + aperture_radius), 0), cols)
+    
+    dy_squared = (np.arange(row_from, row_to) - crow)**2
+    dx_squared = (np.arange(col_from, col_to) - ccol)**2
+    r_squared = dy_squared[:,np.newaxis] + dx_squared[np.newaxis,:]
+    submask = (r_squared <= outer_squared) & (r_squared >= inner_squared)
+    region = (slice(row_from, row_to), slice(col_from, col_to))
+    return region, submask
 
+def generate_circular_mask(dim, center, aperture_radius, obscuration_radius=0):
+    """
+    Generate a circular or annular boolean mask with optional central
+    obscuration. All dimensions in pixels.
+    
+    dim - image dimensions (int for a square image, or (rows, cols) tuple)
+    center or (cx, cy) - center coordinates as tuple
+    aperture_radius - outer radius
+    obscuration_radius - inner radius (default: 0)
+    """
+    mask = np.zeros(_image_shape(dim), dtype="bool")
+    region, submask = circular_mask_region(dim, center, aperture_radius, obscuration_radius)
+    mask[region] = submask
     return mask
 
-def generate_psf_full(dim, aperture_radius, obscuration_radius=0):
+class FFTBackend(object):
+    """
+    Real-input 2D FFTs for PSF generation. Uses pyFFTW when installed
+    (reusing plans between transforms of the same shape), then
+    scipy.fft, then numpy.fft.
+    
+    threads - number of worker threads (pyFFTW and scipy.fft only) (default: 1)
+    single - transform in single precision (pyFFTW and scipy.fft only;
+             numpy.fft always works in double precision) (default: False)
+    """
+    def __init__(self, threads=1, single=False):
+        self.threads = max(int(threads), 1)
+        if single and pyfftw is None and scipy_fft is None:
+            warn("numpy.fft can't transform in single precision, using double precision")
+            single = False
+        self.dtype = np.float32 if single else np.float64
+        self._plans = {}
+    
+    def rfft2(self, data):
+        data = np.asarray(data, dtype=self.dtype)
+        if pyfftw is not None:
+            key = (data.shape, data.dtype)
+            if key not in self._plans:
+                debug("planning", data.shape, "FFT with", self.threads, "threads")
+                self._plans[key] = pyfftw.builders.rfft2(data, threads=self.threads)
+            return self._plans[key](data)
+        if scipy_fft is not None:
+            return scipy_fft.rfft2(data, workers=self.threads)
+        return np.fft.rfft2(data)
+    
+    def power_spectrum(self, data):
+        """
+        |FFT(data)|^2 of a real array, computed from the half plane
+        returned by rfft2 using the Hermitian symmetry of the transform.
+        Zero frequency is at [0, 0], as with np.fft.fft2.
+        """
+        rows, cols = data.shape
+        half = np.abs(self.rfft2(data))**2
+        nhalf = half.shape[1]
+        power = np.empty((rows, cols), dtype=half.dtype)
+        power[:, :nhalf] = half
+        # P[k, j] = P[-k, -j] fills in the columns rfft2 leaves out
+        mirrored = half[:, 1:cols - nhalf + 1][:, ::-1]
+        power[:, nhalf:] = np.roll(mirrored[::-1], 1, axis=0)
+        return power
+
+_default_fft_backend = FFTBackend()
+
+def generate_psf_full(dim, aperture_radius, obscuration_radius=0, backend=None):
     """
     Generate PSF for an aperture
     with optional central obscuration.
@@ -164,10 +293,12 @@ def generate_psf_full(dim, aperture_radius, obscuration_radius=0):
     dim - pupil image size in pixels
     aperture_radius - outer radius
     obscuration_radius - inner radius (central obscuration to add, default: 0)
+    backend - FFTBackend to use (default: single-threaded, double precision)
     """
-    pupilfft = np.fft.fft2(generate_pupil(dim, aperture_radius, obscuration_radius))
-    absfft = np.abs(pupilfft)**2
-    return np.fft.fftshift(absfft)
+    if backend is None:
+        backend = _default_fft_backend
+    pupil = generate_pupil(dim, aperture_radius, obscuration_radius)
+    return np.fft.fftshift(backend.power_spectrum(pupil))
 
 #pretty basic/naive way to find first minimum, assuming we sample finely enough that it's not a subpixel
 def first_min_from_core(psf):
@@ -179,24 +310,148 @@ def first_min_from_core(psf):
             debug("turning point at radius {0}px (row[{1}] = {2} < row[{3}] = {4})".format(i - dim/2, i, row[i], i + 1, row[i + 1]))
             return i
 
-def compute_psf_scale(dimension, primary, secondary, f_number, lambda_mean, pixel_scale):
-    # set the scaling for the PSF from the first min of the unobscured PSF
-    unscaled_psf = generate_psf_full(dimension, primary, 0)
-    first_min_px = first_min_from_core(unscaled_psf)
-    first_min_radius = first_min_px - dimension/2
+def plate_scale(f_number, pixel_scale):
+    """Plate scale in arcseconds per pixel for a pixel pitch in mm"""
     plate_scale_mm = 206265.0 / (1000 * f_number) # TODO: 1000 mm primary hardcoded
-    plate_scale_px = plate_scale_mm * pixel_scale # 13 micron pixels on Andor
+    return plate_scale_mm * pixel_scale # 13 micron pixels on Andor
+
+# first zero of J1, which puts the first Airy minimum at 1.22 lambda / D
+AIRY_FIRST_ZERO = 3.8317059702075125
+
+def _airy_amplitude(v):
+    """2 J1(v) / v, which goes to 1 at v = 0"""
+    v = np.asarray(v, dtype=np.float64)
+    safe_v = np.where(v == 0, 1.0, v)
+    return np.where(v == 0, 1.0, 2.0 * scipy.special.j1(safe_v) / safe_v)
+
+def airy_psf(dim, center, first_min_radius, obscuration_ratio=0.0, oversample=1):
+    """
+    Evaluate the analytic Airy pattern of a circular aperture with
+    optional central obscuration directly on a pixel grid. Normalized
+    to a peak of 1.
+    
+    dim - image dimensions (int for a square image, or (rows, cols) tuple)
+    center or (cx, cy) - center coordinates as tuple
+    first_min_radius - radius in pixels of the first minimum of the
+                       *unobscured* pattern (i.e. 1.22 lambda / D)
+    obscuration_ratio - secondary diameter / primary diameter (default: 0)
+    oversample - average over oversample^2 points in each pixel to
+                 integrate over the pixel area (default: 1, sample
+                 pixel centers)
+    """
+    rows, cols = _image_shape(dim)
+    ccol, crow = center
+    offsets = (np.arange(oversample) + 0.5) / oversample - 0.5
+    y = (np.arange(rows)[:,np.newaxis] + offsets[np.newaxis,:]).ravel() - crow
+    x = (np.arange(cols)[:,np.newaxis] + offsets[np.newaxis,:]).ravel() - ccol
+    v = AIRY_FIRST_ZERO * np.hypot(y[:,np.newaxis], x[np.newaxis,:]) / first_min_radius
+    eps = float(obscuration_ratio)
+    amplitude = (_airy_amplitude(v) - eps**2 * _airy_amplitude(eps * v)) / (1.0 - eps**2)
+    intensity = amplitude**2
+    return intensity.reshape(rows, oversample, cols, oversample).mean(axis=3).mean(axis=1)
+
+def mft_psf(pupil, pupil_diameter, dim, center, lambda_over_d_px, oversample=1):
+    """
+    Evaluate the PSF of an arbitrary pupil only on a grid of detector
+    pixels, using a matrix Fourier transform. Normalized so that the
+    peak of an unaberrated pupil is 1.
+    
+    pupil - 2D array of pupil transmission
+    pupil_diameter - primary diameter in pupil samples
+    dim - output dimensions (int for a square image, or (rows, cols) tuple)
+    center or (cx, cy) - output coordinates of the optical axis
+    lambda_over_d_px - lambda / D in detector pixels
+    oversample - average over oversample^2 points in each pixel to
+                 integrate over the pixel area (default: 1)
+    """
+    rows, cols = _image_shape(dim)
+    ccol, crow = center
+    offsets = (np.arange(oversample) + 0.5) / oversample - 0.5
+    # focal plane coordinates in lambda / D, pupil coordinates in D
+    v = ((np.arange(rows)[:,np.newaxis] + offsets).ravel() - crow) / lambda_over_d_px
+    u = ((np.arange(cols)[:,np.newaxis] + offsets).ravel() - ccol) / lambda_over_d_px
+    y = (np.arange(pupil.shape[0]) - pupil.shape[0] / 2.0) / pupil_diameter
+    x = (np.arange(pupil.shape[1]) - pupil.shape[1] / 2.0) / pupil_diameter
+    transform_y = np.exp(-2j * np.pi * np.outer(v, y))
+    transform_x = np.exp(-2j * np.pi * np.outer(x, u))
+    field = np.dot(np.dot(transform_y, pupil), transform_x)
+    intensity = (np.abs(field) / np.sum(pupil))**2
+    return intensity.reshape(rows, oversample, cols, oversample).mean(axis=3).mean(axis=1)
+
+def _unscaled_first_min(dimension, primary):
+    """Analytic first minimum radius of generate_psf_full(dimension, primary)"""
+    return (AIRY_FIRST_ZERO / math.pi) * dimension / (2.0 * primary)
+
+def compute_psf_scale(dimension, primary, secondary, f_number, lambda_mean, pixel_scale, engine='fft',
+        backend=None):
+    """
+    Work out how to scale a PSF computed on a `dimension`-pixel pupil
+    grid to detector pixels.
+    
+    engine - 'fft' to find the first minimum of the unobscured PSF
+             numerically, or 'airy' or 'mft' to use its analytic
+             position (default: 'fft')
+    backend - FFTBackend for the 'fft' engine (default: None, meaning
+              single-threaded, double precision)
+    
+    Returns (scale_to_physical, plate_scale_px, min_radius_real).
+    """
+    if engine in ('airy', 'mft'):
+        first_min_radius = _unscaled_first_min(dimension, primary)
+    else:
+        # set the scaling for the PSF from the first min of the unobscured PSF
+        unscaled_psf = generate_psf_full(dimension, primary, 0, backend=backend)
+        first_min_px = first_min_from_core(unscaled_psf)
+        first_min_radius = first_min_px - dimension/2
+    plate_scale_px = plate_scale(f_number, pixel_scale)
     theta = math.asin(1.22 * (lambda_mean / 1.0e9)) # TODO: 1e9 nm for our 1m primary
     theta_arcseconds = theta * 206265.0
     min_radius_real = theta_arcseconds * (1.0 / plate_scale_px) # pixel radius to first min
     scale_to_physical = min_radius_real / first_min_radius
     return scale_to_physical, plate_scale_px, min_radius_real
 
-def generate_scaled_psf(dimension, primary, secondary, scale_to_physical):
-    # regenerate the PSF with obscuration in the aperture
-    unscaled_psf_obscured = generate_psf_full(dimension, primary, secondary)
-    scaled_psf = scipy.ndimage.zoom(unscaled_psf_obscured, scale_to_physical)
-    scaled_psf_ctr = scipy.ndimage.center_of_mass(scaled_psf)
+def generate_scaled_psf(dimension, primary, secondary, scale_to_physical, engine='fft', oversample=1,
+        pupil=None, pupil_diameter=None, backend=None):
+    """
+    Generate the obscured PSF sampled on detector pixels.
+    
+    engine - 'fft' to zoom an FFT of the pupil, 'airy' to evaluate
+             the analytic obscured Airy pattern, or 'mft' to transform
+             `pupil` directly onto the detector grid. The latter two
+             use the same output grid the zoomed FFT would have.
+             (default: 'fft')
+    oversample - points per pixel (per axis) to integrate the 'airy'
+                 and 'mft' engines over (default: 1)
+    pupil, pupil_diameter - pupil for the 'mft' engine, as returned by
+                            mft_pupil (default: None, meaning the
+                            annulus from primary and secondary)
+    backend - FFTBackend for the 'fft' engine; share one with
+              compute_psf_scale to reuse its FFT plan (default: None)
+    
+    Returns (scaled_psf, scaled_psf_ctr, max_aperture_radius).
+    """
+    if engine == 'airy':
+        # same output grid the zoomed FFT would have, centered on a pixel
+        size = int(round(dimension * scale_to_physical))
+        scaled_psf_ctr = (float(size / 2), float(size / 2))
+        first_min_radius = scale_to_physical * _unscaled_first_min(dimension, primary)
+        scaled_psf = airy_psf(size, scaled_psf_ctr, first_min_radius,
+            float(secondary) / primary, oversample=oversample)
+    elif engine == 'mft':
+        if pupil is None:
+            pupil, pupil_diameter = mft_pupil(primary, secondary)
+        size = int(round(dimension * scale_to_physical))
+        scaled_psf_ctr = (float(size / 2), float(size / 2))
+        # first minimum is 1.22 lambda / D, which compute_psf_scale
+        # mapped to scale_to_physical * _unscaled_first_min pixels
+        lambda_over_d_px = scale_to_physical * dimension / (2.0 * primary)
+        scaled_psf = mft_psf(pupil, pupil_diameter, size, scaled_psf_ctr,
+            lambda_over_d_px, oversample=oversample)
+    else:
+        # regenerate the PSF with obscuration in the aperture
+        unscaled_psf_obscured = generate_psf_full(dimension, primary, secondary, backend=backend)
+        scaled_psf = scipy.ndimage.zoom(unscaled_psf_obscured, scale_to_physical)
+        scaled_psf_ctr = scipy.ndimage.center_of_mass(scaled_psf)
     max_aperture_radius = scaled_psf.shape[0] / 2
     debug("Scaled PSF to", scaled_psf.shape)
     debug("max aperture radius = ", max_aperture_radius)
@@ -213,7 +468,9 @@ class Frame(object):
     def __init__(self, data, center):
         self.center = center
         self.data = data
-        self._data = data.copy()
+        # original data to start over from; shared rather than copied, so
+        # replace self.data instead of modifying it in place
+        self._data = data
     
     @property
     def x(self): return self.center[0]
@@ -236,20 +493,46 @@ class Frame(object):
         axes.set_ylim(self.ybounds())
         axes.add_artist(matplotlib.patches.Circle(self.center, 20, fill=False, linewidth=2, color="white"))
 
+def _excluded_row_mean(data, exclude_from, exclude_to):
+    """
+    Mean along the row axis (second to last) of `data`, leaving out rows
+    `exclude_from` to `exclude_to`, from the sums on either side of the
+    excluded band (no copies)
+    """
+    nrows = data.shape[-2]
+    exclude_from, exclude_to = max(exclude_from, 0), min(exclude_to, nrows)
+    exclude_to = max(exclude_to, exclude_from)
+    kept_rows = nrows - (exclude_to - exclude_from)
+    if kept_rows < 1:
+        raise ValueError("Excluding rows {0} to {1} leaves none to average".format(exclude_from, exclude_to))
+    total = np.sum(data[...,:exclude_from,:], axis=-2, dtype=np.float64)
+    total += np.sum(data[...,exclude_to:,:], axis=-2, dtype=np.float64)
+    total /= kept_rows
+    return total
+
+def _excluded_row_means(cube, exclude_from, exclude_to):
+    """
+    _excluded_row_mean for each frame of a (frames, rows, cols) cube,
+    leaving out rows exclude_from[i] to exclude_to[i] of frame i
+    """
+    rows = np.arange(cube.shape[-2])
+    keep = ((rows < np.asarray(exclude_from)[:,np.newaxis])
+            | (rows >= np.maximum(exclude_to, exclude_from)[:,np.newaxis]))
+    kept_rows = np.sum(keep, axis=1)
+    if np.any(kept_rows < 1):
+        raise ValueError("Excluding rows {0} to {1} leaves none to average".format(exclude_from, exclude_to))
+    total = np.einsum('fr,frc->fc', keep.astype(np.float64), cube)
+    total /= kept_rows[:,np.newaxis]
+    return total
+
 def avgrow(frame, exclude_from, exclude_to):
     """
     calculate an average row from the image, excluding rows
     from `exclude_from` to `exclude_to`
     """
-    try:
-        ydim, xdim = frame.data.shape
-    except ValueError:
+    if frame.data.ndim != 2:
         raise ValueError("Data array has >2 axes. Is this a data cube?")
-    ydim = ydim - (exclude_to - exclude_from)
-    imgcopy = np.zeros((ydim, xdim))
-    imgcopy[:exclude_from] = frame.data[:exclude_from]
-    imgcopy[exclude_from:] = frame.data[exclude_to:]
-    return np.average(imgcopy, axis=0)
+    return _excluded_row_mean(frame.data, exclude_from, exclude_to)
 
 def avgrow_median_subtract(frame, exclude_from, exclude_to):
     """
@@ -259,13 +542,119 @@ def avgrow_median_subtract(frame, exclude_from, exclude_to):
     exclude_from - beginning of excluded rows range
     exclude_to - end of excluded rows range
     """
-    frame.data = frame._data.copy()
+    frame.data = frame._data
     avg = avgrow(frame, exclude_from, exclude_to)
+    # a new array, so the original data stay untouched
     frame.data = frame.data - avg[np.newaxis,:]
     frame.data -= np.median(frame.data)
     return frame.data
 
-def curve_of_growth(frame, max_aperture, step=1, quiet=True):
+def avgrow_median_subtract_cube(cube, exclude_from, exclude_to, out=None):
+    """
+    avgrow_median_subtract for every frame of a cube at once: subtract
+    each frame's average row (excluding rows `exclude_from` to
+    `exclude_to`) and then its median, reading `cube` once and writing
+    the result once.
+    
+    cube - (frames, rows, cols) array (left unmodified)
+    exclude_from, exclude_to - the same for every frame, or arrays with
+                               one value per frame
+    out - float32 or float64 array the same shape as cube to write the
+          result to, which may be cube itself (default: None, allocate
+          a float64 array)
+    """
+    nframes = cube.shape[0]
+    if np.ndim(exclude_from) == 0 and np.ndim(exclude_to) == 0:
+        avg = _excluded_row_mean(cube, exclude_from, exclude_to)
+    else:
+        avg = _excluded_row_means(cube, exclude_from, exclude_to)
+    if out is None:
+        out = np.empty(cube.shape)
+    np.subtract(cube, avg[:,np.newaxis,:], out=out, casting='unsafe')
+    medians = np.median(out.reshape(nframes, -1), axis=1)
+    out -= medians.astype(out.dtype)[:,np.newaxis,np.newaxis]
+    return out
+
+def _growth_radii(frame, max_aperture, step):
+    """
+    Radii at which curve_of_growth measures: starting from 1px, skip
+    radii that don't enclose any pixels, then grow by `step`.
+    """
+    radii = []
+    current_r = 1
+    
+    while current_r <= max_aperture:
+        if not radii:
+            # enclosed area only grows with radius, so we only need to
+            # check until the first aperture that encloses something
+            region, submask = circular_mask_region(frame.data.shape, frame.center, current_r)
+            if not np.any(submask):
+                print "skipping r = {0} because it didn't enclose at least 1 pixel".format(current_r)
+                current_r += 1
+                continue
+        radii.append(current_r)
+        current_r += step
+    return radii
+
+def _aperture_bounds(center_coord, radii):
+    """
+    Per-radius (from, to) pixel index bounds along one axis, computed
+    the same way as the bounding box in circular_mask_region
+    """
+    lower, upper = center_coord - radii, center_coord + radii
+    lower = np.where(lower < 0.0, np.floor(lower), np.ceil(lower)).astype(int)
+    upper = np.where(upper < 0.0, np.floor(upper), np.ceil(upper)).astype(int)
+    return lower, upper
+
+def binned_curve_of_growth(frame, max_aperture, step=1, quiet=True):
+    """
+    Calculate a curve of growth in a single pass over the pixels around
+    frame.center: each pixel is assigned to the first aperture that
+    encloses it, then counts and fluxes are binned and accumulated.
+    Radii and enclosed pixel counts are identical to measuring each
+    aperture separately.
+    
+    max_aperture - radius in pixels from center where we
+                   stop growing our aperture
+    step - number of pixels to grow radius by (default: 1)
+    quiet - do not emit a line for each step (default: True)
+    """
+    radii = np.array(_growth_radii(frame, max_aperture, step))
+    if len(radii) == 0:
+        frame.radii, frame.fluxes, frame.npix = radii, np.array([]), np.array([], dtype=int)
+        return frame.radii, frame.fluxes, frame.npix
+    
+    # only pixels in the largest aperture's bounding box can contribute
+    region, _ = circular_mask_region(frame.data.shape, frame.center, radii[-1])
+    rows = np.arange(region[0].start, region[0].stop)
+    cols = np.arange(region[1].start, region[1].stop)
+    ccol, crow = frame.center
+    r_squared = ((rows - crow)**2)[:,np.newaxis] + ((cols - ccol)**2)[np.newaxis,:]
+    
+    # index of the first aperture enclosing each pixel, honoring the
+    # (half-open) bounding boxes used by circular_mask_region
+    first = np.searchsorted(radii**2, r_squared, side='left')
+    row_from, row_to = _aperture_bounds(crow, radii)
+    col_from, col_to = _aperture_bounds(ccol, radii)
+    first = np.maximum(first, np.searchsorted(row_to, rows, side='right')[:,np.newaxis])
+    first = np.maximum(first, np.searchsorted(-row_from, -rows, side='left')[:,np.newaxis])
+    first = np.maximum(first, np.searchsorted(col_to, cols, side='right')[np.newaxis,:])
+    first = np.maximum(first, np.searchsorted(-col_from, -cols, side='left')[np.newaxis,:])
+    
+    # pixels outside the largest aperture land in the extra last bin
+    first = first.ravel()
+    nbins = len(radii) + 1
+    npix = np.cumsum(np.bincount(first, minlength=nbins)[:-1])
+    fluxes = np.cumsum(np.bincount(first, weights=frame.data[region].ravel(), minlength=nbins)[:-1])
+    
+    if not quiet:
+        for current_r, flux in zip(radii, fluxes):
+            print "r = {0} encloses {1} counts".format(current_r, flux)
+    
+    frame.radii, frame.fluxes, frame.npix = radii, fluxes, npix
+    return frame.radii, frame.fluxes, frame.npix
+
+def curve_of_growth(frame, max_aperture, step=1, quiet=True, binned=True):
     """
     Calculate a curve of growth by integrating flux in circular apertures
     (centered on frame.center) of successively larger radii
@@ -274,22 +663,28 @@ def curve_of_growth(frame, max_aperture, step=1, quiet=True):
                    stop growing our aperture
     step - number of pixels to grow radius by (default: 1)
     quiet - do not emit a line for each step (default: True)
+    binned - compute every aperture in one pass with
+             binned_curve_of_growth instead of summing each
+             aperture separately (default: True)
     """
+    if binned:
+        return binned_curve_of_growth(frame, max_aperture, step=step, quiet=quiet)
+    
     radii, fluxes, npix = [], [], []
     current_r = 1
     
     while current_r <= max_aperture:
-        mask = generate_circular_mask(frame.data.shape[0], frame.center, current_r)
-        if not np.any(mask):
+        region, submask = circular_mask_region(frame.data.shape, frame.center, current_r)
+        if not np.any(submask):
             print "skipping r = {0} because it didn't enclose at least 1 pixel".format(current_r)
             current_r += 1
             continue
-        flux = np.sum(frame.data[mask])
+        flux = np.sum(frame.data[region][submask])
         if not quiet:
             print "r = {0} encloses {1} counts".format(current_r, flux)
         radii.append(current_r)
         fluxes.append(flux)
-        npix.append(np.sum(mask))
+        npix.append(np.sum(submask))
         current_r += step
     
     frame.radii, frame.fluxes, frame.npix = np.array(radii), np.array(fluxes), np.array(npix)
@@ -341,11 +736,9 @@ def phot_curve_of_growth(frame, original_filename, max_aperture, step=0.5, quiet
         interactive=False,
         verify=False,
     )
-    #shutil.rmtree(tmp_target_dir)
-    debug("output in", tmp_target_dir)
-    
     with open(outfile) as f:
         lines = f.readlines()
+    shutil.rmtree(tmp_target_dir)
     
     # magic numbers for daophot output: skip first 79 lines
     # following lines have this format
@@ -364,6 +757,150 @@ def phot_curve_of_growth(frame, original_filename, max_aperture, step=0.5, quiet
     frame.radii, frame.fluxes, frame.npix = np.array(radii), np.array(fluxes), np.array(npix)
     return frame.radii, frame.fluxes, frame.npix
 
+def _circle_antiderivative(x, r):
+    """Antiderivative of sqrt(r^2 - x^2), with x clipped to [-r, r]"""
+    x = np.clip(x, -r, r)
+    return 0.5 * (x * np.sqrt(r**2 - x**2) + r**2 * np.arcsin(np.clip(x / r, -1.0, 1.0)))
+
+def _quadrant_overlap(x, y, r):
+    """
+    Area of the part of a circle of radius r (centered on the origin)
+    where the coordinates are >= x and >= y. Vectorized over all
+    arguments.
+    """
+    x = np.maximum(x, -r)
+    # the chord at height y spans -w <= x <= w
+    w = np.sqrt(np.maximum(r**2 - y**2, 0.0))
+    # within the chord we get the part of the column above y...
+    lo, hi = np.maximum(x, -w), w
+    area = np.where(
+        hi > lo,
+        _circle_antiderivative(hi, r) - _circle_antiderivative(lo, r) - y * (hi - lo),
+        0.0
+    )
+    # ...and if y is below the center, whole columns outside the chord
+    below = y < 0
+    for lo, hi in ((x, -w), (np.maximum(x, w), r)):
+        area += np.where(
+            below & (hi > lo),
+            2.0 * (_circle_antiderivative(hi, r) - _circle_antiderivative(lo, r)),
+            0.0
+        )
+    return area
+
+def pixel_circle_overlap(x0, y0, x1, y1, r):
+    """
+    Exact area of overlap between the rectangles [x0, x1] x [y0, y1]
+    and a circle of radius r centered on the origin. Vectorized over
+    all arguments.
+    """
+    return (_quadrant_overlap(x0, y0, r) - _quadrant_overlap(x1, y0, r)
+            - _quadrant_overlap(x0, y1, r) + _quadrant_overlap(x1, y1, r))
+
+def aperture_photometry(data, center, radii):
+    """
+    Sum the counts in circular apertures of each of the given radii,
+    using exact fractional pixel/circle overlap areas. Pixel (row, col)
+    covers [row - 0.5, row + 0.5] x [col - 0.5, col + 0.5], so `center`
+    is in the same array coordinates used by curve_of_growth.
+    
+    data - 2D image array
+    center or (cx, cy) - center coordinates as tuple
+    radii - increasing aperture radii in pixels
+    
+    Returns (sums, areas) arrays with one entry per radius.
+    """
+    radii = np.asarray(radii, dtype=float)
+    rows, cols = data.shape
+    ccol, crow = center
+    max_r = radii[-1] + 0.5
+    row_from, row_to = max(int(math.floor(crow - max_r)), 0), min(int(math.ceil(crow + max_r)) + 1, rows)
+    col_from, col_to = max(int(math.floor(ccol - max_r)), 0), min(int(math.ceil(ccol + max_r)) + 1, cols)
+    dy = (np.arange(row_from, row_to) - crow)[:,np.newaxis]
+    dx = (np.arange(col_from, col_to) - ccol)[np.newaxis,:]
+    values = data[row_from:row_to, col_from:col_to].ravel().astype(np.float64)
+    
+    # nearest and farthest distance from the center to each pixel
+    near = np.hypot(np.maximum(np.abs(dx) - 0.5, 0.0), np.maximum(np.abs(dy) - 0.5, 0.0)).ravel()
+    far = np.hypot(np.abs(dx) + 0.5, np.abs(dy) + 0.5).ravel()
+    dx, dy = np.broadcast_arrays(dx, dy)
+    dx, dy = dx.ravel(), dy.ravel()
+    
+    # pixels are wholly inside every aperture from `inside` on, and
+    # partially covered by the apertures from `partial` to `inside`
+    nbins = len(radii) + 1
+    inside = np.searchsorted(radii, far, side='left')
+    partial = np.searchsorted(radii, near, side='right')
+    areas = np.cumsum(np.bincount(inside, minlength=nbins)[:-1]).astype(np.float64)
+    sums = np.cumsum(np.bincount(inside, weights=values, minlength=nbins)[:-1])
+    
+    # expand each partially covered pixel into one entry per aperture
+    counts = np.maximum(inside - partial, 0)
+    pix = np.repeat(np.arange(len(values)), counts)
+    offsets = np.arange(len(pix)) - np.repeat(np.cumsum(counts) - counts, counts)
+    aperture_idx = partial[pix] + offsets
+    overlap = pixel_circle_overlap(
+        dx[pix] - 0.5, dy[pix] - 0.5,
+        dx[pix] + 0.5, dy[pix] + 0.5,
+        radii[aperture_idx]
+    )
+    areas += np.bincount(aperture_idx, weights=overlap, minlength=len(radii))
+    sums += np.bincount(aperture_idx, weights=overlap * values[pix], minlength=len(radii))
+    return sums, areas
+
+def annulus_sky(data, center, annulus=50.0, dannulus=10.0, khist=3.0, binsize=0.1):
+    """
+    Estimate the sky level from pixels whose centers lie in an annulus
+    around `center`, like the apphot "centroid" sky algorithm: the
+    intensity-weighted centroid of the sky histogram within `khist`
+    standard deviations of the mean, in bins of `binsize` sigma.
+    
+    annulus - inner radius of the sky annulus in pixels (default: 50)
+    dannulus - width of the sky annulus in pixels (default: 10)
+    """
+    region, submask = circular_mask_region(data.shape, center, annulus + dannulus, annulus)
+    skypix = data[region][submask].astype(np.float64)
+    if len(skypix) == 0:
+        warn("No pixels in sky annulus, assuming zero sky")
+        return 0.0
+    mean, sigma = np.mean(skypix), np.std(skypix)
+    if sigma == 0:
+        return mean
+    nbins = max(int(round(2.0 * khist / binsize)), 1)
+    hist, edges = np.histogram(skypix, bins=nbins, range=(mean - khist * sigma, mean + khist * sigma))
+    if np.sum(hist) == 0:
+        return mean
+    bin_centers = 0.5 * (edges[:-1] + edges[1:])
+    return np.sum(hist * bin_centers) / np.sum(hist)
+
+def exact_curve_of_growth(frame, max_aperture, step=0.5, quiet=True, fitsky=True,
+        annulus=50.0, dannulus=10.0):
+    """
+    Calculate a curve of growth by integrating flux in circular apertures
+    (centered on frame.center) of successively larger radii, using
+    exact fractional pixel overlaps. This is an in-memory replacement
+    for phot_curve_of_growth that needs no FITS file or IRAF.
+    
+    max_aperture - radius in pixels from center where we
+                   stop growing our aperture
+    step - number of pixels to grow radius by (default: 0.5)
+    quiet - do not emit a line for each step (default: True)
+    fitsky - subtract the sky level measured in an annulus from
+             `annulus` to `annulus` + `dannulus` pixels (default: True)
+    """
+    radii = np.arange(step, max_aperture, step)
+    sums, areas = aperture_photometry(frame.data, frame.center, radii)
+    sky = annulus_sky(frame.data, frame.center, annulus, dannulus) if fitsky else 0.0
+    fluxes = sums - areas * sky
+    
+    if not quiet:
+        debug("sky level", sky)
+        for current_r, flux in zip(radii, fluxes):
+            print "r = {0} encloses {1} counts".format(current_r, flux)
+    
+    frame.radii, frame.fluxes, frame.npix = radii, fluxes, areas
+    return frame.radii, frame.fluxes, frame.npix
+
 def plot_with_arcseconds(outfile, radii, real_values, ideal_values, min_radius_real,
         max_extent_px, plate_scale_px, ylabel="Values at Radius", marker=None):
 
@@ -414,6 +951,128 @@ def profile_from_growthcurve(frame):
     frame.profile = profile / diff_npix
     return frame.profile
 
+def batch_curve_of_growth(stack, centers, radii, chunk_frames=256):
+    """
+    Calculate curves of growth for a whole stack of frames at once,
+    binning every pixel near each center into the first aperture that
+    encloses it (as binned_curve_of_growth does for one frame).
+    
+    stack - (n_frames, rows, cols) array, e.g. a (memory-mapped) cube
+            or a stack of stamps
+    centers - (n_frames, 2) array of (col, row) centers, one per frame
+    radii - aperture radii shared by every frame (e.g. psf.radii)
+    chunk_frames - number of frames binned per vectorized pass, to
+                   bound the size of temporaries (default: 256)
+    
+    Returns (fluxes, npix), each (n_frames, n_radii). Each row is what
+    curve_of_growth gives for that frame at these radii.
+    """
+    centers = np.asarray(centers, dtype=float).reshape(-1, 2)
+    radii = np.asarray(radii, dtype=float)
+    nframes, nrows, ncols = stack.shape
+    nradii = len(radii)
+    nbins = nradii + 1 # extra bin for pixels outside every aperture
+    fluxes = np.zeros((nframes, nradii))
+    npix = np.zeros((nframes, nradii), dtype=int)
+    if nradii == 0:
+        return fluxes, npix
+    
+    # stamp around each center that covers the largest aperture's bounding box
+    half = int(np.ceil(radii[-1])) + 1
+    offsets = np.arange(-half, half + 1)
+    
+    for start in range(0, nframes, chunk_frames):
+        stop = min(start + chunk_frames, nframes)
+        ccol, crow = centers[start:stop,0], centers[start:stop,1]
+        rows = np.floor(crow).astype(int)[:,np.newaxis] + offsets # (frames, width)
+        cols = np.floor(ccol).astype(int)[:,np.newaxis] + offsets
+        
+        r_squared = ((rows - crow[:,np.newaxis])**2)[:,:,np.newaxis] + ((cols - ccol[:,np.newaxis])**2)[:,np.newaxis,:]
+        first = np.searchsorted(radii**2, r_squared, side='left')
+        
+        # honor the (half-open) bounding boxes used by circular_mask_region:
+        # count the apertures whose box doesn't reach each row/column yet
+        row_from, row_to = _aperture_bounds(crow[:,np.newaxis], radii[np.newaxis,:])
+        col_from, col_to = _aperture_bounds(ccol[:,np.newaxis], radii[np.newaxis,:])
+        row_first = np.maximum(
+            np.sum(row_to[:,np.newaxis,:] <= rows[:,:,np.newaxis], axis=2),
+            np.sum(row_from[:,np.newaxis,:] > rows[:,:,np.newaxis], axis=2)
+        )
+        col_first = np.maximum(
+            np.sum(col_to[:,np.newaxis,:] <= cols[:,:,np.newaxis], axis=2),
+            np.sum(col_from[:,np.newaxis,:] > cols[:,:,np.newaxis], axis=2)
+        )
+        first = np.maximum(first, row_first[:,:,np.newaxis])
+        first = np.maximum(first, col_first[:,np.newaxis,:])
+        
+        # pixels off the edge of the frame don't count toward any aperture
+        row_ok = (rows >= 0) & (rows < nrows)
+        col_ok = (cols >= 0) & (cols < ncols)
+        first[~(row_ok[:,:,np.newaxis] & col_ok[:,np.newaxis,:])] = nradii
+        
+        frame_idx = np.arange(start, stop)[:,np.newaxis,np.newaxis]
+        values = stack[frame_idx, np.clip(rows, 0, nrows - 1)[:,:,np.newaxis], np.clip(cols, 0, ncols - 1)[:,np.newaxis,:]]
+        
+        # one bincount over all frames in the chunk, offset per frame
+        bins = (first + nbins * np.arange(stop - start)[:,np.newaxis,np.newaxis]).ravel()
+        counts = np.bincount(bins, minlength=nbins * (stop - start)).reshape(-1, nbins)
+        sums = np.bincount(bins, weights=values.ravel(), minlength=nbins * (stop - start)).reshape(-1, nbins)
+        npix[start:stop] = np.cumsum(counts[:,:-1], axis=1)
+        fluxes[start:stop] = np.cumsum(sums[:,:-1], axis=1)
+    
+    return fluxes, npix
+
+def batch_analyze_frames(stack, centers, max_extent_px, radii):
+    """
+    strehlcube's photometry for a stack of frames at once: subtract each
+    frame's average row, leaving out the rows within `max_extent_px` of
+    its center (which hold the star), and its median, then measure
+    curves of growth at `radii` with batch_curve_of_growth.
+    
+    stack - (n_frames, rows, cols) array
+    centers - (n_frames, 2) array of (col, row) centers, one per frame
+    
+    Returns (fluxes, npix), each (n_frames, n_radii).
+    """
+    centers = np.asarray(centers, dtype=float).reshape(-1, 2)
+    # the rows Frame.ybounds gives for each center
+    inty = centers[:,1].astype(int)
+    r = int(max_extent_px)
+    subtracted = avgrow_median_subtract_cube(stack, inty - r, inty + r)
+    return batch_curve_of_growth(subtracted, centers, radii)
+
+def batch_profile_from_growthcurve(fluxes, npix):
+    """
+    Radial profiles for every row of a batch of curves of growth, as
+    profile_from_growthcurve computes for one frame.
+    
+    Returns (profiles, profile_npix), each (n_frames, n_radii)
+    """
+    fluxes = np.atleast_2d(fluxes)
+    npix = np.atleast_2d(npix)
+    diff_fluxes = np.hstack((fluxes[:,:1], np.diff(fluxes, axis=1)))
+    profile_npix = np.hstack((npix[:,:1], np.diff(npix, axis=1))).astype(float)
+    return diff_fluxes / profile_npix, profile_npix
+
+def batch_strehl(fluxes, psf, normalize_radius):
+    """
+    Strehl ratios for every row of a batch of curves of growth: the
+    ideal PSF's curve of growth and profile are scaled per frame so its
+    maximum enclosed flux within `normalize_radius` pixels equals the
+    frame's.
+    
+    fluxes - (n_frames, n_radii) curves of growth on psf.radii
+    psf - Frame with radii, fluxes and profile of the ideal PSF
+    normalize_radius - radius in pixels within which to take the maxima
+    
+    Returns (strehls, ideal_fluxes, ideal_profiles), each (n_frames, n_radii)
+    """
+    within = psf.radii <= normalize_radius
+    scale_factors = np.max(fluxes[:,within], axis=1) / np.max(psf.fluxes[within])
+    ideal_fluxes = scale_factors[:,np.newaxis] * psf.fluxes[np.newaxis,:]
+    ideal_profiles = scale_factors[:,np.newaxis] * psf.profile[np.newaxis,:]
+    return fluxes / ideal_fluxes, ideal_fluxes, ideal_profiles
+
 def _dao_setup(fwhmpsf, threshold, sigma):
     iraf.digiphot(_doprint=0)
     iraf.digiphot.apphot(_doprint=0)
@@ -429,9 +1088,16 @@ def _dao_setup(fwhmpsf, threshold, sigma):
     
     findpars.threshold = threshold # only care about brightest
 
-def daofind_brightest(filename, fwhmpsf=2.5, threshold=20.0):
+def daofind_brightest(filename, fwhmpsf=2.5, threshold=20.0, data=None):
+    """
+    Run daofind on an image and return the record for the brightest source.
+    
+    filename - FITS file or IRAF image section (e.g. "cube.fits[*,*,12]")
+    data - pixel data for `filename`, if already loaded (default: None)
+    """
     debug("finding brightest in", filename)
-    data = pyfits.getdata(filename)
+    if data is None:
+        data = pyfits.getdata(filename)
     sigma = np.std(data) * 0.75 # background stddev... approximated because we don't know where the star IS yet
     
     _dao_setup(fwhmpsf, threshold, sigma)
@@ -468,3 +1134,257 @@ def daofind_brightest(filename, fwhmpsf=2.5, threshold=20.0):
     
     shutil.rmtree(tmp_target_dir)
     return brightest
+
+def _daofind_kernel(fwhmpsf, nsigma=1.5):
+    """
+    DAOFIND's "lowered" Gaussian kernel: a circular Gaussian of the given
+    FWHM, truncated at `nsigma` sigma and shifted to zero sum, scaled so
+    that convolving with it gives the amplitude of the best fitting
+    Gaussian above a flat background.
+    
+    Returns (kernel, footprint, sigma, relerr), where relerr is the
+    amplitude error for unit pixel noise.
+    """
+    sigma = fwhmpsf / (2.0 * math.sqrt(2.0 * math.log(2.0)))
+    radius = max(2.0, nsigma * sigma)
+    nhalf = int(radius)
+    y, x = np.mgrid[-nhalf:nhalf + 1, -nhalf:nhalf + 1]
+    r_squared = x**2 + y**2
+    footprint = r_squared <= radius**2
+    gauss = np.exp(-r_squared / (2.0 * sigma**2))
+    inside = gauss[footprint]
+    denom = np.sum(inside**2) - np.sum(inside)**2 / len(inside)
+    kernel = np.where(footprint, (gauss - np.mean(inside)) / denom, 0.0)
+    return kernel, footprint, sigma, 1.0 / math.sqrt(denom)
+
+def find_sources(data, fwhmpsf=2.5, threshold=20.0, sigma=None,
+        sharplo=0.2, sharphi=1.0, roundlo=-1.0, roundhi=1.0):
+    """
+    Find point sources in an image the way DAOFIND does: convolve with
+    a lowered Gaussian kernel, keep local maxima more than `threshold`
+    sigma above the background, and filter them on sharpness and
+    roundness.
+    
+    data - 2D image array
+    fwhmpsf - FWHM of the PSF in pixels (default: 2.5)
+    threshold - detection threshold in units of `sigma` (default: 20)
+    sigma - background noise (default: None, estimated as in
+            daofind_brightest)
+    
+    Returns a structured array with the same columns as a daofind .coo
+    file (see util.parse_coo_file), with 1-indexed IRAF coordinates.
+    """
+    data = np.asarray(data, dtype=np.float64)
+    if sigma is None:
+        # same background estimate daofind_brightest hands to daofind
+        sigma = np.std(data) * 0.75 * 0.75
+    kernel, footprint, gauss_sigma, relerr = _daofind_kernel(fwhmpsf)
+    nhalf = kernel.shape[0] // 2
+    threshold_eff = threshold * sigma * relerr
+    
+    density = scipy.ndimage.convolve(data, kernel, mode='constant')
+    peaks = (density == scipy.ndimage.maximum_filter(density, footprint=footprint, mode='constant'))
+    peaks &= density > threshold_eff
+    # kernel must fit entirely on the image
+    peaks[:nhalf] = peaks[-nhalf:] = False
+    peaks[:, :nhalf] = peaks[:, -nhalf:] = False
+    rows, cols = np.nonzero(peaks)
+    found = np.zeros(len(rows), dtype=COO_DTYPE)
+    if len(rows) == 0:
+        return found
+    
+    # (npeaks, size, size) cutouts around each peak
+    offsets = np.arange(-nhalf, nhalf + 1)
+    row_idx = (rows[:,np.newaxis] + offsets)[:,:,np.newaxis]
+    col_idx = (cols[:,np.newaxis] + offsets)[:,np.newaxis,:]
+    cutouts = data[row_idx, col_idx] * footprint
+    densities = density[row_idx, col_idx] * footprint
+    height = densities[:, nhalf, nhalf].copy()
+    
+    # sharpness: central pixel above its neighbors, relative to the fit amplitude
+    neighbors = np.sum(cutouts, axis=(1, 2)) - cutouts[:, nhalf, nhalf]
+    sharpness = (cutouts[:, nhalf, nhalf] - neighbors / (np.sum(footprint) - 1)) / height
+    
+    # symmetry-based roundness from the quadrants of the convolved cutout
+    densities[:, nhalf, nhalf] = 0.0
+    quadrant_sum = (-np.sum(densities[:, :nhalf + 1, nhalf + 1:], axis=(1, 2))
+                    + np.sum(densities[:, :nhalf, :nhalf + 1], axis=(1, 2))
+                    - np.sum(densities[:, nhalf:, :nhalf], axis=(1, 2))
+                    + np.sum(densities[:, nhalf + 1:, nhalf:], axis=(1, 2)))
+    sround = 2.0 * quadrant_sum / np.sum(np.abs(densities), axis=(1, 2))
+    
+    # marginal-fit roundness from lowered 1D Gaussian fits to the row
+    # and column sums
+    gauss_1d = np.exp(-offsets**2 / (2.0 * gauss_sigma**2))
+    lowered_1d = gauss_1d - np.mean(gauss_1d)
+    hx = np.dot(np.sum(cutouts, axis=1), lowered_1d) / np.sum(lowered_1d**2)
+    hy = np.dot(np.sum(cutouts, axis=2), lowered_1d) / np.sum(lowered_1d**2)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ground = np.where(hx + hy != 0, 2.0 * (hx - hy) / (hx + hy), 0.0)
+    
+    # sub-pixel position from a parabola through the density peak
+    def vertex(left, center, right):
+        curvature = left - 2.0 * center + right
+        with np.errstate(divide='ignore', invalid='ignore'):
+            shift = np.where(curvature < 0, 0.5 * (left - right) / curvature, 0.0)
+        return np.clip(shift, -0.5, 0.5)
+    dx = vertex(density[rows, cols - 1], density[rows, cols], density[rows, cols + 1])
+    dy = vertex(density[rows - 1, cols], density[rows, cols], density[rows + 1, cols])
+    
+    found['XCENTER'] = cols + dx + 1.0
+    found['YCENTER'] = rows + dy + 1.0
+    found['MAG'] = -2.5 * np.log10(height / threshold_eff)
+    found['SHARPNESS'] = sharpness
+    found['SROUND'] = sround
+    found['GROUND'] = ground
+    keep = ((sharpness >= sharplo) & (sharpness <= sharphi)
+            & (sround >= roundlo) & (sround <= roundhi)
+            & (ground >= roundlo) & (ground <= roundhi))
+    found = found[keep]
+    found['ID'] = np.arange(1, len(found) + 1)
+    return found
+
+def native_brightest(data, fwhmpsf=2.5, threshold=20.0):
+    """
+    In-process replacement for daofind_brightest, using find_sources.
+    Returns the record for the brightest source found in `data`.
+    """
+    found_stars = find_sources(data, fwhmpsf, threshold)
+    if len(found_stars) == 0:
+        warn("HAX: halving threshold to try and get a detection")
+        found_stars = find_sources(data, fwhmpsf, threshold / 2.0)
+    if len(found_stars) == 0:
+        raise RuntimeError("No sources found above {0} sigma".format(threshold / 2.0))
+    found_stars.sort(order=['MAG'])
+    brightest = found_stars[0]
+    debug("brightest found @", brightest['XCENTER'], ',', brightest['YCENTER'], 'with mag', brightest['MAG'])
+    return brightest
+
+def find_brightest(filename, fwhmpsf=2.5, threshold=20.0, data=None, finder='native'):
+    """
+    Locate the brightest source in an image with either finder.
+    
+    filename - FITS file or IRAF image section (e.g. "cube.fits[*,*,12]")
+    data - pixel data for `filename`, if already loaded (default: None)
+    finder - 'native' for native_brightest or 'daofind' for
+             daofind_brightest (default: 'native')
+    """
+    if finder == 'daofind':
+        return daofind_brightest(filename, fwhmpsf, threshold, data=data)
+    if data is None:
+        data = pyfits.getdata(filename)
+    return native_brightest(data, fwhmpsf, threshold)
+
+# tracking-quality flags reported by SourceTracker.locate
+TRACK_FIXED = -1 # center given, no search
+TRACK_FULL = 0 # full-frame search
+TRACK_REFINED = 1 # found in the window around the predicted position
+TRACK_REACQUIRED = 2 # lost in the window, found again by a full-frame search
+TRACK_CENTROID = 3 # center from a center table or batch centroiding (see centroid.py)
+
+class SourceTracker(object):
+    """
+    Follows the brightest source through a cube. The first frame gets a
+    full-frame search; after that the source is only looked for in a
+    small window around where it is predicted to be (from its last
+    position and frame-to-frame motion), so the per-frame cost doesn't
+    depend on the frame size. When the source isn't found in the window,
+    fall back to a full-frame search.
+    
+    Windowed searches always use the native find_sources on the window,
+    whatever `finder` is; with finder='daofind', only the full-frame
+    searches run IRAF daofind, so a track mixes the two finders'
+    centering.
+    
+    fwhmpsf, threshold, finder - as for find_brightest
+    window - half-width in pixels of the search box around the
+             predicted position; 0 disables tracking (default: 10)
+    """
+    def __init__(self, fwhmpsf=2.5, threshold=20.0, window=10, finder='native'):
+        self.fwhmpsf = fwhmpsf
+        self.threshold = threshold
+        self.window = int(window)
+        self.finder = finder
+        self.position = None
+        self.velocity = (0.0, 0.0)
+        self.sigma = None
+    
+    def predicted(self):
+        """Predicted (x, y) of the source in the next frame (IRAF coordinates)"""
+        return (self.position[0] + self.velocity[0], self.position[1] + self.velocity[1])
+    
+    def locate(self, data, filename=None):
+        """
+        Find the source in the next frame.
+        
+        data - 2D frame array
+        filename - FITS file or image section for `data`, only needed
+                   for full-frame searches with the daofind finder
+        
+        Returns (brightest, flag), where brightest is a record like the
+        one from find_brightest and flag is one of the TRACK_* values.
+        """
+        if self.window > 0 and self.position is not None:
+            bright = self._search_window(data)
+            if bright is not None:
+                x, y = bright['XCENTER'], bright['YCENTER']
+                self.velocity = (x - self.position[0], y - self.position[1])
+                self.position = (x, y)
+                return bright, TRACK_REFINED
+            warn("Lost source near", self.predicted(), "- searching the whole frame")
+            flag = TRACK_REACQUIRED
+        else:
+            flag = TRACK_FULL
+        bright = find_brightest(filename, self.fwhmpsf, self.threshold, data=data, finder=self.finder)
+        # remember the background noise so windowed searches needn't look at the whole frame
+        self.sigma = np.std(data) * 0.75 * 0.75
+        self.position = (bright['XCENTER'], bright['YCENTER'])
+        self.velocity = (0.0, 0.0)
+        return bright, flag
+    
+    def _search_window(self, data):
+        rows, cols = data.shape
+        x, y = self.predicted()
+        # pad by the kernel size, since find_sources skips peaks that close to the edge
+        nhalf = _daofind_kernel(self.fwhmpsf)[0].shape[0] // 2
+        # IRAF coordinates are 1-indexed
+        ccol, crow = int(round(x - 1.0)), int(round(y - 1.0))
+        halfwidth = self.window + nhalf
+        row_from, row_to = max(crow - halfwidth, 0), min(crow + halfwidth + 1, rows)
+        col_from, col_to = max(ccol - halfwidth, 0), min(ccol + halfwidth + 1, cols)
+        if row_to - row_from <= 2 * nhalf or col_to - col_from <= 2 * nhalf:
+            return None
+        found = find_sources(data[row_from:row_to, col_from:col_to], self.fwhmpsf,
+            self.threshold, sigma=self.sigma)
+        if len(found) == 0:
+            return None
+        found.sort(order=['MAG'])
+        brightest = found[0]
+        brightest['XCENTER'] += col_from
+        brightest['YCENTER'] += row_from
+        return brightest
+
+def track_frames(frames, fwhmpsf=2.5, threshold=20.0, window=10, finder='native', image_section=None):
+    """
+    Follow the brightest source through a sequence of frames, in order,
+    with a single SourceTracker, so the centers and track flags don't
+    depend on how the frames are split up for analysis afterwards.
+    
+    frames - iterable of (frame number, frame data) pairs, e.g. from
+             util.iter_cube_frames
+    fwhmpsf, threshold, window, finder - as for SourceTracker
+    image_section - function giving the FITS file or image section for
+                    a frame number, only needed for full-frame searches
+                    with the daofind finder (default: None)
+    
+    Returns a dict mapping frame number to ((xcenter, ycenter), flag),
+    with 1-indexed IRAF coordinates and one of the TRACK_* flags.
+    """
+    tracker = SourceTracker(fwhmpsf, threshold, window=window, finder=finder)
+    tracks = {}
+    for frame_num, frame_data in frames:
+        filename = image_section(frame_num) if image_section is not None else None
+        bright, flag = tracker.locate(frame_data, filename)
+        tracks[frame_num] = ((float(bright['XCENTER']), float(bright['YCENTER'])), flag)
+        debug("frame #", frame_num, "has brightest at", bright['XCENTER'], bright['YCENTER'], "(track flag", flag, ")")
+    return tracks
@@ -0,0 +1,97 @@
+from pyraf import iraf
+import math
+import os
+import time
+import numpy as np
+# why won't logging work in PyRAF :(
+from aotools.util import debug, info, warn, error, GrowingCube, NumberedPngs
+from aotools.strehl import batch_analyze_frames, batch_strehl, SourceTracker
+from aotools.psfcache import ideal_psf
+from aotools.series import StrehlSeriesWriter, read_strehl_series
+
+def strehlfollow(source, filepattern, seriesfile, primary, secondary, dimension, f_number,
+        pixel_scale, lambda_mean, growth_step, fwhmpsf, threshold, quiet,
+        psfcache=True, psfengine='fft', oversample=1, pupilfile='', spiders=0, spider_width=0.0,
+        fftthreads=1, fftsingle=False, finder='native', track=True, track_window=10,
+        poll=0.05, batch=100, timeout=0.0):
+    start_time = time.time()
+    info("Started at:", start_time)
+    if filepattern and finder == 'daofind':
+        raise RuntimeError("IRAF daofind can't read PNG frames, use finder=native")
+    # pick up after the last frame already in the series, so frame
+    # numbers never repeat
+    last_frame = 0
+    if os.path.exists(os.path.join(seriesfile, 'frame.npy')):
+        existing = read_strehl_series(seriesfile)['frame']
+        if len(existing):
+            last_frame = int(existing[-1])
+            info("Resuming", seriesfile, "after frame", last_frame)
+        del existing
+    if filepattern:
+        frames = NumberedPngs(source, filepattern, skip=last_frame)
+    else:
+        frames = GrowingCube(source, skip=last_frame)
+    # I: compute ideal psf once for the whole session
+    psf, scale_to_physical, plate_scale_px, min_radius_real, max_aperture_radius = ideal_psf(
+        dimension,
+        primary,
+        secondary,
+        f_number,
+        pixel_scale,
+        lambda_mean,
+        growth_step,
+        engine=psfengine,
+        oversample=oversample,
+        spiders=spiders,
+        spider_width=spider_width,
+        pupilfile=pupilfile,
+        fft_threads=fftthreads,
+        single=fftsingle,
+        quiet=quiet,
+        use_cache=psfcache
+    )
+    max_extent_px = 2.5 / plate_scale_px # After 2.5" we're almost certainly measuring noise
+    # report the Strehl ratio enclosed by the first minimum as frames come in
+    report_idx = np.argmin(np.abs(psf.radii - min_radius_real))
+    
+    # II: analyze frames as they arrive, appending each batch to the series
+    tracker = SourceTracker(fwhmpsf, threshold, window=track_window if track else 0, finder=finder)
+    writer = StrehlSeriesWriter(seriesfile, psf.radii, append=True)
+    analyzed = 0
+    last_arrival = time.time()
+    info("Following", source, "- interrupt to stop")
+    try:
+        while True:
+            new_frames = frames.poll(max_frames=batch)
+            if not new_frames:
+                if timeout > 0 and time.time() - last_arrival > timeout:
+                    info("No new frames for", timeout, "s, stopping")
+                    break
+                time.sleep(poll)
+                continue
+            last_arrival = time.time()
+            frame_nums, centers, track_flags = [], [], []
+            for frame_num, frame_data in new_frames:
+                bright, track_flag = tracker.locate(frame_data, frames.image_section(frame_num))
+                frame_nums.append(frame_num)
+                centers.append((float(bright['XCENTER']), float(bright['YCENTER'])))
+                track_flags.append(track_flag)
+            stack = np.array([frame_data for frame_num, frame_data in new_frames], dtype=np.float64)
+            fluxes, npix = batch_analyze_frames(stack, centers, max_extent_px, psf.radii)
+            strehls, ideal_fluxes, ideal_profiles = batch_strehl(fluxes, psf, max_extent_px)
+            writer.append(np.array(frame_nums), np.array(centers), np.array(track_flags), strehls, fluxes)
+            analyzed += len(frame_nums)
+            info("frame", frame_nums[-1], "Strehl", round(strehls[-1, report_idx], 4),
+                "within r =", psf.radii[report_idx], "px", "({0} frames in {1:.3f} s)".format(
+                len(frame_nums), time.time() - last_arrival))
+    except KeyboardInterrupt:
+        info("Stopped following", source)
+    finally:
+        writer.close()
+    
+    info("Analyzed", analyzed, "frames into", seriesfile)
+    info("Completed at:", time.time())
+    info("Total time:", time.time() - start_time)
+
+parfile = iraf.osfn("aotools$strehlfollow.par")
+t = iraf.IrafTaskFactory(taskname="strehlfollow", value=parfile, function=strehlfollow)
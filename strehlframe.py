@@ -12,45 +12,46 @@ from aotools.util import debug, info, warn, error, write_table
 from aotools.strehl import (Frame, generate_pupil, generate_circular_mask, 
     generate_psf_full, compute_psf_scale, generate_scaled_psf, 
     first_min_from_core, avgrow, avgrow_median_subtract, curve_of_growth,
-    profile_from_growthcurve, plot_with_arcseconds, daofind_brightest
+    profile_from_growthcurve, plot_with_arcseconds, find_brightest
 )
+from aotools.psfcache import ideal_psf
 
 def strehlframe(image, primary, secondary, dimension, f_number, pixel_scale,
         lambda_mean, growth_step, find_source, xcenter, ycenter, fwhmpsf,
-        threshold, quiet):
+        threshold, quiet, psfcache=True, psfengine='fft', oversample=1,
+        pupilfile='', spiders=0, spider_width=0.0, fftthreads=1, fftsingle=False,
+        finder='native'):
     start_time = time.time()
     info("Started at:", start_time)
     if not os.path.exists(image):
         raise RuntimeError("No file named {0}".format(image))
     # Were we given coordinates, or do we need to find the source?
     if find_source:
-        bright = daofind_brightest(image, fwhmpsf, threshold)
+        bright = find_brightest(image, fwhmpsf, threshold, finder=finder)
         center_col, center_row = bright['XCENTER'], bright['YCENTER']
     else:
         center_col, center_row = xcenter, ycenter
     
-    scale_to_physical, plate_scale_px, min_radius_real = compute_psf_scale(
+    # ideal psf, with CoG and profile precomputed to be rescaled later
+    psf, scale_to_physical, plate_scale_px, min_radius_real, max_aperture_radius = ideal_psf(
         dimension,
         primary,
         secondary,
         f_number,
+        pixel_scale,
         lambda_mean,
-        pixel_scale
+        growth_step,
+        engine=psfengine,
+        oversample=oversample,
+        spiders=spiders,
+        spider_width=spider_width,
+        pupilfile=pupilfile,
+        fft_threads=fftthreads,
+        single=fftsingle,
+        quiet=quiet,
+        use_cache=psfcache
     )
     
-    scaled_psf, scaled_psf_ctr, max_aperture_radius = generate_scaled_psf(
-        dimension,
-        primary,
-        secondary,
-        scale_to_physical
-    )
-    
-    # wrap psf in a frame
-    psf = Frame(scaled_psf, scaled_psf_ctr)
-    # precompute CoG and profile to be rescaled later
-    curve_of_growth(psf, max_aperture_radius, step=growth_step, quiet=quiet)
-    profile_from_growthcurve(psf)
-    
     # values and functions to rescale our PSF Frame computed values
     # to physical counts
     max_extent_px = 2.5 / plate_scale_px # After 2.5" we're almost certainly measuring noise
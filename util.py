@@ -1,7 +1,18 @@
 import os.path
 import os, errno
+import re
+import glob
+import time
+import collections
+import multiprocessing
+import hashlib
 from pyraf import iraf
 import numpy
+import pyfits
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
 from aotools.colorama import red, yellow, green, cyan, white
 
 # TODO: figure out why PyRAF eats output from normal Python logging
@@ -27,42 +38,886 @@ def ensure_dir(path):
         if e.errno != errno.EEXIST:
             raise
 
-def combine_cube_frames(cubefile, range_pairs, target_dir):
-    dirname, filename = os.path.split(cubefile)
-    filebase = filename.rsplit('.', 1)[0]
-    if len(filebase) > 8:
-        warn("IRAF doesn't like long filenames. "
-             "Consider shortening the cube filename ({0})".format(filebase))
+def iter_cube_frames(cubefile, range_pairs):
+    """
+    Yield (frame number, frame data) for each frame in the one-indexed,
+    inclusive ranges in `range_pairs`, read straight out of the
+    memory-mapped FITS cube. Unscaled frames are views into the file
+    (no copies or temporary files); frames with BSCALE/BZERO are scaled
+    one at a time.
+    """
+    hdulist = pyfits.open(cubefile, memmap=True, do_not_scale_image_data=True)
+    try:
+        header = hdulist[0].header
+        cube = hdulist[0].data
+        bscale, bzero = header.get('BSCALE', 1), header.get('BZERO', 0)
+        nframes = cube.shape[0]
+        for fromidx, toidx in range_pairs:
+            if fromidx < 1 or toidx > nframes:
+                raise ValueError("Frame range {0}-{1} is outside the cube "
+                                 "(frames 1-{2})".format(fromidx, toidx, nframes))
+            for i in range(fromidx, toidx + 1):
+                frame = cube[i - 1]
+                if bscale != 1 or bzero != 0:
+                    frame = frame * bscale + bzero
+                yield i, frame
+    finally:
+        hdulist.close()
+
+# default memory budget for one chunk of a streamed cube operation
+DEFAULT_CHUNK_MB = 64
+
+def _scaled(data, bscale, bzero):
+    if bscale != 1 or bzero != 0:
+        return data * bscale + bzero
+    return data
+
+def chunk_frame_count(frame_shape, chunk_mb=DEFAULT_CHUNK_MB, itemsize=8):
+    """
+    Number of frames of `frame_shape` (at `itemsize` bytes per pixel,
+    default float64) that fit in `chunk_mb` megabytes, at least 1
+    """
+    frame_bytes = int(numpy.prod(frame_shape)) * itemsize
+    return max(1, int(chunk_mb * 2**20) // frame_bytes)
+
+def iter_cube_chunks(cubefile, chunk_frames, scale=True, frame_range=None):
+    """
+    Yield (start index, chunk) for consecutive chunks of up to
+    `chunk_frames` frames from the memory-mapped FITS cube, where
+    start is the zero-based index of the chunk's first frame. Only
+    one chunk (scaled by BSCALE/BZERO, if present and `scale` is True)
+    is in memory at a time. A single 2D image is treated as a cube of
+    one frame.
     
-    outfiles = []
+    frame_range - zero-based, half-open (start, stop) range of frames
+                  to read (default: None, the whole cube)
+    """
+    hdulist = pyfits.open(cubefile, memmap=True, do_not_scale_image_data=True)
+    try:
+        header = hdulist[0].header
+        cube = hdulist[0].data
+        if cube.ndim == 2:
+            cube = cube[numpy.newaxis]
+        bscale, bzero = header.get('BSCALE', 1), header.get('BZERO', 0)
+        first, last = frame_range if frame_range is not None else (0, cube.shape[0])
+        for start in range(first, last, chunk_frames):
+            chunk = cube[start:min(start + chunk_frames, last)]
+            yield start, _scaled(chunk, bscale, bzero) if scale else chunk
+    finally:
+        hdulist.close()
+
+def iter_cube_tiles(cubefile, chunk_mb=DEFAULT_CHUNK_MB):
+    """
+    Yield ((row slice, column slice), tile) for tiles of pixels spanning
+    every frame of the memory-mapped FITS cube, each tile (frames, rows,
+    cols) sized to about `chunk_mb` megabytes as float64: bands of whole
+    rows where they fit, otherwise pieces of one row. Useful for
+    reductions along the frame axis, like a median, that need every
+    frame of a pixel.
+    """
+    hdulist = pyfits.open(cubefile, memmap=True, do_not_scale_image_data=True)
+    try:
+        header = hdulist[0].header
+        cube = hdulist[0].data
+        bscale, bzero = header.get('BSCALE', 1), header.get('BZERO', 0)
+        nframes, nrows, ncols = cube.shape
+        tile_pixels = chunk_frame_count((nframes,), chunk_mb)
+        tile_rows, tile_cols = max(1, tile_pixels // ncols), min(tile_pixels, ncols)
+        for row_start in range(0, nrows, tile_rows):
+            rows = slice(row_start, min(row_start + tile_rows, nrows))
+            for col_start in range(0, ncols, tile_cols):
+                cols = slice(col_start, min(col_start + tile_cols, ncols))
+                yield (rows, cols), _scaled(cube[:, rows, cols], bscale, bzero)
+    finally:
+        hdulist.close()
+
+def reciprocal_flat(flat, dtype=numpy.float32):
+    """
+    Reciprocal of a flat field as `dtype`, for flat-fielding by
+    multiplication, along with a mask of the bad pixels (zero, negative
+    or non-finite in the flat), which are set to 0 in the reciprocal
+    """
+    flat = numpy.asarray(flat, dtype=numpy.float64)
+    bad = ~numpy.isfinite(flat) | (flat <= 0)
+    inverse = numpy.zeros(flat.shape, dtype=dtype)
+    numpy.divide(1.0, flat, out=inverse, where=~bad, casting='unsafe')
+    return inverse, bad
+
+def tiled_cube_median(cubefile, chunk_mb=DEFAULT_CHUNK_MB):
+    """
+    Per-pixel median along the frame axis of a FITS cube, computed with
+    numpy.median for one tile of pixels through every frame at a time
+    (see iter_cube_tiles)
+    """
+    header = pyfits.getheader(cubefile)
+    median_frame = numpy.zeros((header['NAXIS2'], header['NAXIS1']))
+    for (rows, cols), tile in iter_cube_tiles(cubefile, chunk_mb=chunk_mb):
+        median_frame[rows, cols] = numpy.median(tile, axis=0)
+    return median_frame
+
+def integer_cube_median(cubefile, chunk_mb=DEFAULT_CHUNK_MB, radix_bits=None):
+    """
+    Exact per-pixel median along the frame axis of an integer FITS cube
+    (BITPIX 8, 16 or 32), by radix selection: each pass streams the cube
+    once, building a per-pixel histogram of the next `radix_bits` bits
+    of the values that still match the median's known leading bits.
+    Memory use is 2**radix_bits 32 bit counters per pixel plus one chunk
+    of frames, whatever the length of the cube.
+    
+    radix_bits - bits selected per pass, 1, 2 or 4 (default: None, the
+                 most whose counters fit in `chunk_mb`)
+    
+    The result is identical to numpy.median(cube, axis=0) on the
+    (BSCALE/BZERO scaled) cube.
+    """
+    header = pyfits.getheader(cubefile)
+    bitpix = header['BITPIX']
+    nframes, nrows, ncols = header['NAXIS3'], header['NAXIS2'], header['NAXIS1']
+    bscale, bzero = header.get('BSCALE', 1), header.get('BZERO', 0)
+    npix = nrows * ncols
+    if radix_bits is None:
+        # fewer buckets mean more passes over the cube, but less memory
+        radix_bits = 1
+        for bits in (4, 2):
+            if 2**bits * npix * 4 <= chunk_mb * 2**20:
+                radix_bits = bits
+                break
+    if bitpix not in (8, 16, 32) or bitpix % radix_bits != 0:
+        raise TypeError("Can't radix select {0} bit data {1} bits at a time".format(bitpix, radix_bits))
+    # FITS 8 bit data are unsigned, the rest signed; shift them to 0 and up
+    offset = 0 if bitpix == 8 else 2**(bitpix - 1)
+    nbuckets = 2**radix_bits
+    chunk_frames = chunk_frame_count((nrows, ncols), chunk_mb)
+    count_dtype = numpy.int32 if nframes < 2**31 else numpy.int64
+    pixel_index = numpy.arange(npix)
+    
+    def iter_values():
+        for start, chunk in iter_cube_chunks(cubefile, chunk_frames, scale=False):
+            yield chunk.reshape(chunk.shape[0], npix).astype(numpy.int64) + offset
+    
+    # select the lower median (the upper one too, for an odd frame count)
+    lower_rank = (nframes - 1) // 2
+    prefix = numpy.zeros(npix, dtype=numpy.int64)
+    rank = numpy.empty(npix, dtype=numpy.int64)
+    rank.fill(lower_rank)
+    counts = numpy.empty((nbuckets, npix), dtype=count_dtype)
+    flat_counts = counts.reshape(-1)
+    for shift in range(bitpix - radix_bits, -1, -radix_bits):
+        counts.fill(0)
+        for values in iter_values():
+            for frame_values in values:
+                bins = ((frame_values >> shift) & (nbuckets - 1)) * npix + pixel_index
+                if shift + radix_bits < bitpix:
+                    bins = bins[(frame_values >> (shift + radix_bits)) == prefix]
+                # one bin per pixel, so no index repeats within a frame
+                flat_counts[bins] += 1
+        cumulative = numpy.cumsum(counts, axis=0, out=counts)
+        digit = numpy.zeros(npix, dtype=numpy.int64)
+        for bucket in range(nbuckets):
+            digit += cumulative[bucket] <= rank
+        below = numpy.where(digit > 0, cumulative[numpy.maximum(digit - 1, 0), pixel_index], 0)
+        equal = cumulative[digit, pixel_index] - below # on the last pass
+        rank -= below
+        prefix = (prefix << radix_bits) | digit
+    lower = prefix
+    
+    # for an even frame count, the upper median is the next larger value
+    # unless enough frames share the lower median's value
+    at_or_below = (lower_rank - rank) + equal
+    upper = lower.copy()
+    need_next = at_or_below <= nframes // 2
+    if numpy.any(need_next):
+        next_larger = numpy.empty(npix, dtype=numpy.int64)
+        next_larger.fill(numpy.iinfo(numpy.int64).max)
+        for values in iter_values():
+            larger = numpy.where(values > lower, values, numpy.iinfo(numpy.int64).max)
+            next_larger = numpy.minimum(next_larger, larger.min(axis=0))
+        upper[need_next] = next_larger[need_next]
+    
+    lower = (lower - offset) * bscale + bzero
+    upper = (upper - offset) * bscale + bzero
+    return ((lower + upper) / 2.0).reshape(nrows, ncols)
+
+def cube_median(cubefile, chunk_mb=DEFAULT_CHUNK_MB):
+    """
+    Exact per-pixel median along the frame axis of a FITS cube, using
+    bounded memory: integer_cube_median for integer data, otherwise
+    tiled_cube_median
+    """
+    if pyfits.getval(cubefile, 'BITPIX') in (8, 16, 32):
+        return integer_cube_median(cubefile, chunk_mb=chunk_mb)
+    return tiled_cube_median(cubefile, chunk_mb=chunk_mb)
+
+BITPIX_FOR_DTYPE = {
+    'uint8': 8,
+    'int16': 16,
+    'int32': 32,
+    'int64': 64,
+    'float32': -32,
+    'float64': -64,
+}
+
+# describe the data layout, so they're never copied from a template header
+_STRUCTURAL_KEYWORDS = ('SIMPLE', 'XTENSION', 'BITPIX', 'NAXIS', 'EXTEND',
+                        'PCOUNT', 'GCOUNT', 'BSCALE', 'BZERO', 'BLANK', 'END')
+
+def image_header(shape, dtype, template=None, extension=False):
+    """
+    Build a primary header for an image of `shape` (NumPy order, e.g.
+    (frames, rows, cols)) and `dtype`, copying every non-structural
+    card (EXPOSURE, comments, history...) from `template` if given.
+    With `extension`, build an IMAGE extension header instead.
+    """
+    dtype = numpy.dtype(dtype)
+    if dtype.name not in BITPIX_FOR_DTYPE:
+        raise TypeError("Can't write {0} data to FITS without scaling".format(dtype.name))
+    header = pyfits.Header()
+    if extension:
+        header['XTENSION'] = 'IMAGE'
+    else:
+        header['SIMPLE'] = True
+    header['BITPIX'] = BITPIX_FOR_DTYPE[dtype.name]
+    header['NAXIS'] = len(shape)
+    for axis, length in enumerate(reversed(shape)):
+        header['NAXIS{0}'.format(axis + 1)] = length
+    if extension:
+        header['PCOUNT'] = 0
+        header['GCOUNT'] = 1
+    if template is not None:
+        for card in template.cards:
+            keyword = card.keyword
+            if keyword in _STRUCTURAL_KEYWORDS or (keyword.startswith('NAXIS') and keyword != 'NAXIS'):
+                continue
+            header.append(card)
+    return header
+
+class FitsCubeWriter(object):
+    """
+    Writes a FITS image chunk by chunk, so it never has to be in memory
+    all at once. The header is written when the first chunk arrives
+    (taking BITPIX from the chunk's dtype), and chunks are appended in
+    order until `nframes` frames have been written.
+    
+    outfile - path to the FITS file to create (must not exist)
+    nframes - number of frames in the finished cube
+    frame_shape - (rows, cols) of each frame
+    template - header to copy non-structural cards from (default: None)
+    squeeze - write a 2D image instead of a cube if nframes is 1
+              (default: False)
+    """
+    def __init__(self, outfile, nframes, frame_shape, template=None, squeeze=False):
+        if os.path.exists(outfile):
+            raise IOError("File {0} already exists".format(outfile))
+        self.outfile = outfile
+        self.nframes = nframes
+        self.frame_shape = tuple(frame_shape)
+        self.template = template
+        self.squeeze = squeeze and nframes == 1
+        self.written = 0
+        self._hdu = None
+    
+    def write(self, chunk):
+        """Append `chunk`, an array of one or more frames, to the file"""
+        chunk = numpy.asarray(chunk)
+        if chunk.ndim == 2:
+            chunk = chunk[numpy.newaxis]
+        if self.written + chunk.shape[0] > self.nframes:
+            raise ValueError("Writing past the last of {0} frames in {1}".format(self.nframes, self.outfile))
+        if self._hdu is None:
+            shape = self.frame_shape if self.squeeze else (self.nframes,) + self.frame_shape
+            header = image_header(shape, chunk.dtype, self.template)
+            self._hdu = pyfits.StreamingHDU(self.outfile, header)
+        self._hdu.write(chunk)
+        self.written += chunk.shape[0]
+    
+    def close(self):
+        if self._hdu is None:
+            return
+        if self.written != self.nframes:
+            warn("Only wrote", self.written, "of", self.nframes, "frames to", self.outfile)
+        self._hdu.close()
+        self._hdu = None
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.close()
+
+def stream_cube(infile, outfile, func, chunk_mb=DEFAULT_CHUNK_MB):
+    """
+    Apply `func` to consecutive chunks of frames from `infile` and
+    write the results to `outfile` as they are computed, keeping only
+    about `chunk_mb` megabytes of frames in memory at once.
+    
+    func - called as func(chunk, start), where chunk is a
+           (frames, rows, cols) array and start the zero-based index
+           of its first frame; returns the output frames for the chunk.
+           Unscaled chunks are read-only views of the memory-mapped
+           file, so func must not modify chunk in place; write the
+           results to another array (which may be reused between calls,
+           since each chunk is written out before the next one is read)
+    
+    A 2D input image is handled as a single frame and written as 2D.
+    The header of `infile` (minus structural keywords) is carried over.
+    """
+    header = pyfits.getheader(infile)
+    shape = tuple(header['NAXIS{0}'.format(axis)] for axis in range(header['NAXIS'], 0, -1))
+    if len(shape) == 2:
+        nframes, frame_shape = 1, shape
+    else:
+        nframes, frame_shape = shape[0], shape[1:]
+    chunk_frames = chunk_frame_count(frame_shape, chunk_mb)
+    debug("streaming", nframes, "frames of", infile, "in chunks of", chunk_frames)
+    with FitsCubeWriter(outfile, nframes, frame_shape, template=header, squeeze=len(shape) == 2) as writer:
+        for start, chunk in iter_cube_chunks(infile, chunk_frames):
+            writer.write(func(chunk, start))
+    return outfile
+
+# unsigned integer types FITS stores as signed, offset by BZERO
+UNSIGNED_BZERO = {
+    'uint16': 2**15,
+    'uint32': 2**31,
+}
+
+def fits_storage(dtype):
+    """
+    (dtype, BZERO) that FITS stores `dtype` data as: unsigned integers
+    other than bytes become signed integers offset by BZERO, everything
+    else is stored as is (BZERO 0)
+    """
+    dtype = numpy.dtype(dtype)
+    bzero = UNSIGNED_BZERO.get(dtype.name, 0)
+    if bzero:
+        return numpy.dtype('int{0}'.format(8 * dtype.itemsize)), bzero
+    return dtype, 0
+
+class FitsMemmapWriter(object):
+    """
+    A FITS image preallocated on disk and filled in through a memory map
+    of its data section, so frames can be written in any order (e.g. as
+    a pool of decoders finishes them) without the image ever being in
+    memory. Assign to it like an array: writer[i] = frame.
+    
+    outfile - path to the FITS file to create (must not exist)
+    shape - shape of the image (NumPy order, e.g. (frames, rows, cols))
+    dtype - data type of the image; uint16 and uint32 are stored as
+            signed integers with BZERO, the FITS convention
+    template - header to copy non-structural cards from (default: None)
+    """
+    def __init__(self, outfile, shape, dtype, template=None):
+        if os.path.exists(outfile):
+            raise IOError("File {0} already exists".format(outfile))
+        self.outfile = outfile
+        self.shape = tuple(shape)
+        self.dtype = numpy.dtype(dtype)
+        stored, self.bzero = fits_storage(self.dtype)
+        header = image_header(self.shape, stored, template)
+        if self.bzero:
+            header['BSCALE'] = 1
+            header['BZERO'] = self.bzero
+        header_bytes = header.tostring().encode('ascii')
+        data_bytes = int(numpy.prod(self.shape)) * stored.itemsize
+        with open(outfile, 'wb') as f:
+            f.write(header_bytes)
+            # zero-filled data section, padded to whole FITS blocks
+            f.truncate(len(header_bytes) + -(-data_bytes // 2880) * 2880)
+        self._data = numpy.memmap(outfile, dtype=stored.newbyteorder('>'), mode='r+',
+            offset=len(header_bytes), shape=self.shape)
+    
+    def __setitem__(self, index, values):
+        if self.bzero:
+            values = numpy.asarray(values, dtype=numpy.int64) - self.bzero
+        self._data[index] = values
+    
+    def close(self):
+        if self._data is None:
+            return
+        self._data.flush()
+        self._data = None
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.close()
+
+def read_png(path):
+    """
+    Decode a grayscale PNG into an array of its native type: uint8 for
+    8-bit images and uint16 for 16-bit ones (which PIL may hand back as
+    32-bit integers)
+    """
+    if Image is None:
+        raise ImportError("Reading PNGs needs the Python Imaging Library (PIL or Pillow)")
+    img = Image.open(path)
+    data = numpy.array(img)
+    if img.mode in ('I', 'I;16', 'I;16B') and data.dtype != numpy.uint16:
+        # PNG has no deeper grayscale than 16 bits
+        data = data.astype(numpy.uint16)
+    return data
+
+def _numbered_regex(filepattern):
+    # turn filepattern into a regex, capturing the digits of `$i`
+    return re.compile(re.escape(filepattern).replace(re.escape('$i'), r'(\d+)') + '$')
+
+def find_numbered_files(directory, filepattern):
+    """
+    Paths of the files in `directory` matching `filepattern` (with `$i`
+    standing for an integer index), as (index, path) pairs sorted by
+    index instead of lexically
+    (i.e. [99.png, 100.png, 990.png] not [100.png, 99.png, 990.png])
+    """
+    regex = _numbered_regex(filepattern)
+    filetuples = []
+    for f in glob.glob(os.path.join(directory, "*")):
+        _, fname = os.path.split(f)
+        match = regex.match(fname)
+        if match:
+            filetuples.append((int(match.groups()[0]), f))
+    filetuples.sort()
+    return filetuples
+
+class NumberedPngs(object):
+    """
+    Follows a directory that a camera is writing numbered PNG frames
+    into (see find_numbered_files), handing out each new frame once it
+    can be decoded. Frames are numbered from 1 in order of their index,
+    like the frames of a cube from pngtocube.
     
+    A poll only looks for the file with the next index (numbered like
+    the last one, zero padding and all), so its cost doesn't grow with
+    the number of frames in the directory. Every `rescan` seconds
+    without that file turning up, the directory is listed again to
+    catch frames that skip an index; only names not listed before are
+    matched against the pattern.
+    
+    skip - number of frames (in index order) to pass over, e.g. ones
+           already analyzed (default: 0)
+    rescan - seconds between directory listings (default: 1.0)
+    """
+    def __init__(self, directory, filepattern, skip=0, rescan=1.0):
+        self.directory = directory
+        self.filepattern = filepattern
+        self.regex = _numbered_regex(filepattern)
+        self.rescan = rescan
+        self.listed = set() # names already matched (or not) against the pattern
+        self.pending = collections.deque() # (index, digits, name) in index order
+        self.count = 0
+        self.last_digits = None
+        self._scan()
+        for i in range(min(skip, len(self.pending))):
+            self._take()
+    
+    def image_section(self, frame_num):
+        # PNGs aren't IRAF images
+        return None
+    
+    def _scan(self):
+        found = []
+        for name in os.listdir(self.directory):
+            if name in self.listed:
+                continue
+            self.listed.add(name)
+            match = self.regex.match(name)
+            if match:
+                digits = match.group(1)
+                found.append((int(digits), digits, name))
+        if found:
+            self.pending = collections.deque(sorted(list(self.pending) + found))
+        self.last_scan = time.time()
+    
+    def _take(self):
+        index, digits, name = self.pending.popleft()
+        self.last_digits = digits
+        self.count += 1
+    
+    def _check_next(self):
+        """Queue the file with the index after the last frame, if it exists"""
+        if self.last_digits is None or self.pending:
+            return
+        digits = str(int(self.last_digits) + 1).zfill(len(self.last_digits))
+        name = self.filepattern.replace('$i', digits)
+        if name not in self.listed and os.path.exists(os.path.join(self.directory, name)):
+            self.listed.add(name)
+            self.pending.append((int(digits), digits, name))
+    
+    def poll(self, max_frames=None):
+        """
+        List of (frame number, frame data) for up to `max_frames` frames
+        that have appeared since the last poll
+        """
+        self._check_next()
+        if not self.pending and (self.last_digits is None or time.time() - self.last_scan >= self.rescan):
+            self._scan()
+        new_frames = []
+        while self.pending and (max_frames is None or len(new_frames) < max_frames):
+            index, digits, name = self.pending[0]
+            try:
+                data = read_png(os.path.join(self.directory, name))
+            except (IOError, SyntaxError, ValueError):
+                # still being written; try again next time
+                break
+            self._take()
+            new_frames.append((self.count, data))
+            self._check_next()
+        return new_frames
+
+def fits_header_bytes(path):
+    """
+    Length of the primary header of the FITS file at `path`, or None if
+    it isn't completely written yet
+    """
+    nbytes = 0
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(2880)
+            if len(block) < 2880:
+                return None
+            nbytes += 2880
+            for card in range(0, 2880, 80):
+                if block[card:card + 8] == b'END     ':
+                    return nbytes
+
+class GrowingCube(object):
+    """
+    Follows a FITS cube that a camera is still appending frames to,
+    handing out each frame once all of it is on disk. Frames are counted
+    from the file size, up to NAXIS3 if the header gives it.
+    
+    skip - number of frames to pass over, e.g. ones already analyzed
+           (default: 0)
+    """
+    def __init__(self, cubefile, skip=0):
+        self.cubefile = cubefile
+        self.next = skip # zero-based index of the next frame to hand out
+    
+    def image_section(self, frame_num):
+        return "{0}[*,*,{1}]".format(self.cubefile, frame_num)
+    
+    def poll(self, max_frames=None):
+        """
+        List of (frame number, frame data) for up to `max_frames` frames
+        that have been completed since the last poll
+        """
+        if not os.path.exists(self.cubefile):
+            return []
+        offset = fits_header_bytes(self.cubefile)
+        if offset is None:
+            return []
+        with open(self.cubefile, 'rb') as f:
+            header = pyfits.Header.fromstring(f.read(offset).decode('ascii'))
+        dtype = dict((bitpix, name) for name, bitpix in BITPIX_FOR_DTYPE.items())[header['BITPIX']]
+        dtype = numpy.dtype(dtype).newbyteorder('>')
+        frame_shape = (header['NAXIS2'], header['NAXIS1'])
+        frame_bytes = frame_shape[0] * frame_shape[1] * dtype.itemsize
+        available = (os.path.getsize(self.cubefile) - offset) // frame_bytes
+        if header['NAXIS'] == 2:
+            available = min(available, 1)
+        elif header.get('NAXIS3', 0) > 0:
+            available = min(available, header['NAXIS3'])
+        if max_frames is not None:
+            available = min(available, self.next + max_frames)
+        if available <= self.next:
+            return []
+        frames = numpy.array(numpy.memmap(self.cubefile, dtype=dtype, mode='r',
+            offset=offset + self.next * frame_bytes, shape=(available - self.next,) + frame_shape),
+            dtype=dtype.newbyteorder('='))
+        frames = _scaled(frames, header.get('BSCALE', 1), header.get('BZERO', 0))
+        new_frames = [(self.next + i + 1, frame) for i, frame in enumerate(frames)]
+        self.next = available
+        return new_frames
+
+def iter_range_sums(cubefile, range_pairs, combine='sum', chunk_mb=DEFAULT_CHUNK_MB):
+    """
+    Yield (fromidx, toidx, frame) with the sum (or mean) of the frames
+    in each one-indexed, inclusive range of `range_pairs`, in order.
+    
+    The cube is streamed once from the first to the last frame needed,
+    keeping a running cumulative sum along the frame axis; each range's
+    sum is the difference of the cumulative sums at its ends. Only the
+    cumulative sums at the ends of ranges not yet finished are kept, so
+    ranges can overlap or come in any order. Integer data are summed
+    exactly in 64-bit integers.
+    
+    combine - 'sum' or 'average' (default: 'sum')
+    """
+    if combine not in ('sum', 'average'):
+        raise ValueError("Unknown combine operation {0}".format(combine))
+    range_pairs = list(range_pairs)
+    if not range_pairs:
+        return
+    header = pyfits.getheader(cubefile)
+    nframes = header['NAXIS3']
+    frame_shape = (header['NAXIS2'], header['NAXIS1'])
     for fromidx, toidx in range_pairs:
-        inlst = os.path.join(target_dir, 'in.lst')
-        infiles = []
-        for i in range(fromidx, toidx+1):
-            infiles.append(cubefile + "[*,*,{0}]".format(i))
-        
-        f = open(inlst, 'w')
-        f.writelines(infiles)
-        f.write('\n')
-        f.close()
+        if fromidx < 1 or toidx > nframes or toidx < fromidx:
+            raise ValueError("Frame range {0}-{1} is outside the cube "
+                             "(frames 1-{2})".format(fromidx, toidx, nframes))
+    scaled = header.get('BSCALE', 1) != 1 or header.get('BZERO', 0) != 0
+    accumulator = numpy.int64 if header['BITPIX'] > 0 and not scaled else numpy.float64
+    
+    # cumulative sums we need, counted by how many pending ranges use them;
+    # index k holds the sum of frames first+1 to k (one-indexed)
+    first = min(fromidx for fromidx, toidx in range_pairs) - 1
+    last = max(toidx for fromidx, toidx in range_pairs)
+    needed = {}
+    for fromidx, toidx in range_pairs:
+        for k in (fromidx - 1, toidx):
+            needed[k] = needed.get(k, 0) + 1
+    cumulative = {first: numpy.zeros(frame_shape, dtype=accumulator)}
+    running = cumulative[first]
+    next_out = 0
+    
+    chunk_frames = chunk_frame_count(frame_shape, chunk_mb)
+    for start, chunk in iter_cube_chunks(cubefile, chunk_frames, frame_range=(first, last)):
+        sums = numpy.cumsum(chunk, axis=0, dtype=accumulator)
+        sums += running
+        for k in range(start + 1, start + chunk.shape[0] + 1):
+            if k in needed:
+                cumulative[k] = sums[k - start - 1].copy()
+        running = sums[-1].copy()
+        done = start + chunk.shape[0]
         
+        while next_out < len(range_pairs) and range_pairs[next_out][1] <= done:
+            fromidx, toidx = range_pairs[next_out]
+            frame = (cumulative[toidx] - cumulative[fromidx - 1]).astype(numpy.float64)
+            if combine == 'average':
+                frame /= toidx - fromidx + 1
+            yield fromidx, toidx, frame
+            next_out += 1
+            for k in (fromidx - 1, toidx):
+                needed[k] -= 1
+                if needed[k] == 0:
+                    del needed[k]
+                    cumulative.pop(k, None)
+
+def _combined_header(header, range_pairs, combine, cubefile):
+    """
+    Copy of `header` for frames combined from `range_pairs`, with
+    NCOMBINE and (for sums) the exposure time updated when every
+    range has the same length
+    """
+    header = header.copy()
+    counts = set(toidx - fromidx + 1 for fromidx, toidx in range_pairs)
+    if len(counts) == 1:
+        count = counts.pop()
+        header['NCOMBINE'] = count
+        if combine == 'sum':
+            for key in ('EXPOSURE', 'EXPTIME'):
+                if key in header:
+                    header[key] = float(header[key]) * count
+    if len(range_pairs) == 1:
+        header.add_history("{0} of frames {1}-{2} of {3}".format(combine, range_pairs[0][0], range_pairs[0][1], cubefile))
+    else:
+        header.add_history("{0} of {1} frame ranges of {2}".format(combine, len(range_pairs), cubefile))
+    return header
+
+def combine_cube_frames(cubefile, range_pairs, target_dir, combine='sum', chunk_mb=DEFAULT_CHUNK_MB):
+    """
+    Sum (or average) each one-indexed, inclusive range of frames in
+    `range_pairs` and write each result to its own FITS file in
+    `target_dir`, named like `cube_10-40.fit`. The cube's header is
+    carried over to each file. Returns the list of files written.
+    """
+    dirname, filename = os.path.split(cubefile)
+    filebase = filename.rsplit('.', 1)[0]
+    header = pyfits.getheader(cubefile)
+    
+    outfiles = []
+    for fromidx, toidx, frame in iter_range_sums(cubefile, range_pairs, combine=combine, chunk_mb=chunk_mb):
         outfile = '{0}/{1}_{2}-{3}.fit'.format(target_dir, filebase, fromidx, toidx)
-        debug("imcombine input={input} output={output} combine=sum reject=none".format(
-            input="@{0}".format(inlst), #','.join(infiles),
-            output=outfile,
-        ))
+        frame_header = image_header(frame.shape, frame.dtype, _combined_header(header, [(fromidx, toidx)], combine, cubefile))
+        pyfits.PrimaryHDU(frame, header=frame_header).writeto(outfile)
+        debug("Wrote", combine, "of frames", fromidx, "to", toidx, "to", outfile)
         outfiles.append(outfile)
-        iraf.imcombine(
-            input=','.join(infiles),
-            output=outfile,
-            combine="sum",
-            reject="none",
-            # project='no', # IRAF wants bools specified / default is nonboolean?
-            # mclip='no',
-        )
     return outfiles
 
+def combine_cube_frames_to_cubes(cubefile, outputs, combine='sum', chunk_mb=DEFAULT_CHUNK_MB):
+    """
+    Build several combined cubes from one pass over `cubefile`.
+    
+    outputs - list of (outfile, range_pairs): each output cube gets the
+              sum (or average) of each of its one-indexed, inclusive
+              ranges as consecutive frames, in order of their last frame
+    
+    Frames are written as soon as they are computed, and the cube's
+    header is carried over to every output.
+    """
+    header = pyfits.getheader(cubefile)
+    frame_shape = (header['NAXIS2'], header['NAXIS1'])
+    # every range of every output, in the order the stream finishes them
+    tagged = sorted(
+        (toidx, fromidx, output_idx)
+        for output_idx, (outfile, range_pairs) in enumerate(outputs)
+        for fromidx, toidx in range_pairs
+    )
+    writers = [
+        FitsCubeWriter(outfile, len(range_pairs), frame_shape,
+                       template=_combined_header(header, range_pairs, combine, cubefile))
+        for outfile, range_pairs in outputs
+    ]
+    try:
+        all_ranges = [(fromidx, toidx) for toidx, fromidx, output_idx in tagged]
+        frames = iter_range_sums(cubefile, all_ranges, combine=combine, chunk_mb=chunk_mb)
+        for (toidx, fromidx, output_idx), (_, _, frame) in zip(tagged, frames):
+            writers[output_idx].write(frame)
+    finally:
+        for writer in writers:
+            writer.close()
+    for outfile, range_pairs in outputs:
+        info("Wrote", len(range_pairs), "combined frames to", outfile)
+    return [outfile for outfile, range_pairs in outputs]
+
+def combine_cube_frames_to_cube(cubefile, range_pairs, outfile, combine='sum', chunk_mb=DEFAULT_CHUNK_MB):
+    """
+    Sum (or average) each one-indexed, inclusive range of frames in
+    `range_pairs` and write the results as consecutive frames (in order
+    of their last frame) of a new FITS cube, one at a time as they are
+    computed. The cube's header is carried over.
+    """
+    return combine_cube_frames_to_cubes(cubefile, [(outfile, range_pairs)], combine=combine, chunk_mb=chunk_mb)[0]
+
+def split_ranges(range_pairs, nchunks):
+    """
+    Split one-indexed, inclusive frame ranges into at most `nchunks`
+    contiguous chunks of nearly equal length, each a list of
+    (fromidx, toidx) pairs. Chunks are returned in frame order.
+    """
+    total = sum(toidx - fromidx + 1 for fromidx, toidx in range_pairs)
+    if total < 1:
+        return []
+    nchunks = max(1, min(nchunks, total))
+    base, extra = divmod(total, nchunks)
+    sizes = [base + 1] * extra + [base] * (nchunks - extra)
+    chunks = []
+    chunk, remaining = [], sizes.pop(0)
+    for fromidx, toidx in range_pairs:
+        while fromidx <= toidx:
+            take = min(remaining, toidx - fromidx + 1)
+            chunk.append((fromidx, fromidx + take - 1))
+            fromidx += take
+            remaining -= take
+            if remaining == 0:
+                chunks.append(chunk)
+                chunk = []
+                if sizes:
+                    remaining = sizes.pop(0)
+    return chunks
+
+# set in the parent just before the pool forks, so workers inherit the
+# analysis closure (and the ideal PSF it refers to) instead of unpickling it
+_chunk_worker_factory = None
+
+def _analyze_frames(analyze, cubefile, range_pairs, stacked):
+    frames = iter_cube_frames(cubefile, range_pairs)
+    if stacked:
+        frame_nums, frame_data = zip(*frames)
+        return analyze(list(frame_nums), numpy.array(frame_data))
+    return [analyze(frame_num, frame_data) for frame_num, frame_data in frames]
+
+def _analyze_chunk(args):
+    cubefile, range_pairs, stacked = args
+    return _analyze_frames(_chunk_worker_factory(), cubefile, range_pairs, stacked)
+
+def imap_cube_frames(cubefile, range_pairs, make_worker, workers=1, chunk_frames=None, stacked=False):
+    """
+    Analyze frames of a cube, optionally across a pool of `workers`
+    processes, yielding the list of per-frame results for each
+    contiguous chunk of frames, in frame order, as soon as it and the
+    chunks before it are done.
+    
+    make_worker - called once per contiguous chunk of frames to get a
+        function `analyze(frame_num, frame_data)` returning that frame's
+        result (so per-chunk state like a SourceTracker isn't shared
+        between processes); called only once when workers is 1
+    workers - number of processes (default: 1, analyze in this process)
+    chunk_frames - most frames in a chunk (default: None, a few chunks
+        per worker)
+    stacked - call `analyze(frame_nums, frames)` once per chunk instead,
+        with a (frames, rows, cols) array of the chunk's frames, to get
+        the list of their results (default: False)
+    
+    Each worker memory-maps the cube itself, so frame data is shared
+    through the page cache rather than pickled. Anything `make_worker`
+    closes over is inherited by the forked workers and computed only once.
+    """
+    global _chunk_worker_factory
+    total = sum(toidx - fromidx + 1 for fromidx, toidx in range_pairs)
+    # a few chunks per worker to even out the load
+    nchunks = workers * 4 if workers > 1 else 1
+    if chunk_frames:
+        nchunks = max(nchunks, -(-total // chunk_frames))
+    chunks = split_ranges(range_pairs, nchunks)
+    if workers <= 1:
+        analyze = make_worker()
+        for chunk in chunks:
+            yield _analyze_frames(analyze, cubefile, chunk, stacked)
+        return
+    debug("analyzing", len(chunks), "chunks of", cubefile, "with", workers, "workers")
+    _chunk_worker_factory = make_worker
+    pool = multiprocessing.Pool(workers)
+    try:
+        results = pool.imap(_analyze_chunk, [(cubefile, chunk, stacked) for chunk in chunks])
+        for chunk in chunks:
+            # a timeout on next() keeps Ctrl-C working while we wait
+            yield results.next(1e9)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        _chunk_worker_factory = None
+
+def map_cube_frames(cubefile, range_pairs, make_worker, workers=1, chunk_frames=None, stacked=False):
+    """
+    Analyze frames of a cube like imap_cube_frames, returning all of the
+    per-frame results together, in frame order
+    """
+    return [row for chunk_rows in imap_cube_frames(cubefile, range_pairs, make_worker, workers=workers,
+                chunk_frames=chunk_frames, stacked=stacked)
+            for row in chunk_rows]
+
+def exclude_frames(range_pairs, frames):
+    """
+    One-indexed, inclusive frame ranges covering the frames of
+    `range_pairs` (in order, each once) that aren't in `frames`
+    """
+    frames = set(frames)
+    remaining = []
+    for fromidx, toidx in range_pairs:
+        for i in range(fromidx, toidx + 1):
+            if i in frames:
+                continue
+            frames.add(i)
+            if remaining and remaining[-1][1] == i - 1:
+                remaining[-1] = (remaining[-1][0], i)
+            else:
+                remaining.append((i, i))
+    return remaining
+
+def file_checksum(path, sample_blocks=64, block_bytes=2**20):
+    """
+    SHA-1 checksum identifying the contents of a (large) file cheaply:
+    covers the file size and up to `sample_blocks` blocks of
+    `block_bytes` spread evenly through it, always including the first
+    and last blocks (and so the FITS header). Files smaller than
+    sample_blocks * block_bytes are hashed completely.
+    """
+    size = os.path.getsize(path)
+    checksum = hashlib.sha1(str(size))
+    nblocks = -(-size // block_bytes)
+    if nblocks <= sample_blocks:
+        offsets = range(0, nblocks)
+    else:
+        offsets = sorted(set(int(round(i * (nblocks - 1) / float(sample_blocks - 1))) for i in range(sample_blocks)))
+    with open(path, 'rb') as f:
+        for block in offsets:
+            f.seek(block * block_bytes)
+            checksum.update(f.read(block_bytes))
+    return checksum.hexdigest()
+
 def write_table(filename, columns, **kwargs):
     names = []
     data = []
@@ -70,27 +925,26 @@ def write_table(filename, columns, **kwargs):
         names.append(colname)
         data.append(coldata)
     
-    zipped_data = zip(*data)
     kwargs['delimiter'] = u'\t'
     kwargs['header'] = kwargs['delimiter'].join(names)
     if not 'fmt' in kwargs.keys():
         kwargs['fmt'] = "%5.5f"
-    numpy.savetxt(filename, zipped_data, **kwargs)
+    numpy.savetxt(filename, numpy.column_stack(data), **kwargs)
     debug("Wrote file", filename)
 
+# columns of a daofind .coo file
+COO_DTYPE = [
+    ('XCENTER', numpy.float64),
+    ('YCENTER', numpy.float64),
+    ('MAG', numpy.float64),
+    ('SHARPNESS', numpy.float64),
+    ('SROUND', numpy.float64),
+    ('GROUND', numpy.float64),
+    ('ID', numpy.int32)
+]
+
 def parse_coo_file(filename):
-    arr = numpy.genfromtxt(
-        filename,
-        dtype=[
-            ('XCENTER', numpy.float64),
-            ('YCENTER', numpy.float64),
-            ('MAG', numpy.float64),
-            ('SHARPNESS', numpy.float64),
-            ('SROUND', numpy.float64),
-            ('GROUND', numpy.float64),
-            ('ID', numpy.int32)
-        ]
-    )
+    arr = numpy.genfromtxt(filename, dtype=COO_DTYPE)
     if len(arr.shape) < 1:
         return arr[numpy.newaxis] # want single row file to behave like rows
     else: